@@ -0,0 +1,122 @@
+import math
+import threading
+import numpy as np
+
+# Resolutions that can be queried, and the bucket size in seconds of each rollup
+ROLLUPS = {"minute": 60, "hour": 3600}
+RESOLUTIONS = ["raw"] + sorted(ROLLUPS.keys())
+
+class RingBuffer:
+	""" Fixed-size ring of rows, backed by a NumPy array, rows are appended in timestamp order """
+	def __init__(self, capacity, columns):
+		self.data = np.zeros((capacity, columns))
+		self.capacity = capacity
+		self.start = 0
+		self.count = 0
+
+	def append(self, row):
+		""" Appends a row, overwriting the oldest row if the ring is full """
+		index = (self.start + self.count) % self.capacity
+		self.data[index] = row
+		if(self.count < self.capacity):
+			self.count += 1
+		else:
+			self.start = (self.start + 1) % self.capacity
+
+	def last(self):
+		""" Returns the most recent row, it can be modified in place """
+		return self.data[(self.start + self.count - 1) % self.capacity]
+
+	def select(self, start, end):
+		""" Returns the rows with first column in [start, end], in order, using a binary search per segment """
+		segments = list()
+		if(self.start + self.count <= self.capacity):
+			segments.append(self.data[self.start:self.start + self.count])
+		else:
+			segments.append(self.data[self.start:])
+			segments.append(self.data[:(self.start + self.count) % self.capacity])
+		selected = list()
+		for segment in segments:
+			low = np.searchsorted(segment[:, 0], start, side="left")
+			high = np.searchsorted(segment[:, 0], end, side="right")
+			selected.append(segment[low:high])
+		return np.concatenate(selected)
+
+class ActivitySeries:
+	"""
+		Activity history of a single camera
+		Raw points are kept in a ring, with a moving average maintained as points are added,
+		and rolled up into minute and hour buckets (count, sum, min, max) so long ranges are cheap to query
+	"""
+	def __init__(self, capacity=2880, window_size=5, rollup_capacity=(1440, 24 * 90)):
+		# Raw rows are (timestamp, value, moving average)
+		self.raw = RingBuffer(capacity, 3)
+		self.window_size = window_size
+		self.window = RingBuffer(window_size, 1)
+		self.window_sum = 0.0
+		# Rollup rows are (bucket start, count, sum, min, max)
+		self.rollups = dict()
+		for (name, size) in zip(sorted(ROLLUPS.keys()), rollup_capacity):
+			self.rollups[name] = RingBuffer(size, 5)
+		self.lock = threading.Lock()
+
+	def add_point(self, timestamp, value):
+		""" Adds an activity value, timestamps are expected to increase """
+		value = float(value)
+		with self.lock:
+			if(self.window.count == self.window_size):
+				self.window_sum -= self.window.data[self.window.start][0]
+			self.window.append((value,))
+			self.window_sum += value
+			self.raw.append((timestamp, value, self.window_sum / self.window.count))
+			for (name, rollup) in self.rollups.items():
+				bucket = math.floor(timestamp / ROLLUPS[name]) * ROLLUPS[name]
+				if(rollup.count and rollup.last()[0] == bucket):
+					row = rollup.last()
+					row[1] += 1
+					row[2] += value
+					row[3] = min(row[3], value)
+					row[4] = max(row[4], value)
+				elif(not rollup.count or rollup.last()[0] < bucket):
+					rollup.append((bucket, 1, value, value, value))
+
+	def moving_average(self):
+		""" Returns the average of the last window_size values """
+		with self.lock:
+			if(not self.window.count):
+				return 0.0
+			return self.window_sum / self.window.count
+
+	def query(self, start, end, resolution="raw"):
+		""" Returns a list of dicts for the points or buckets in [start, end], resolution is one of RESOLUTIONS """
+		with self.lock:
+			if(resolution == "raw"):
+				rows = self.raw.select(start, end)
+				return [{"time": row[0], "value": row[1], "average": row[2]} for row in rows.tolist()]
+			# Include the bucket containing start
+			bucket_start = math.floor(start / ROLLUPS[resolution]) * ROLLUPS[resolution]
+			rows = self.rollups[resolution].select(bucket_start, end)
+			return [{"time": row[0], "count": int(row[1]), "mean": row[2] / row[1], "min": row[3], "max": row[4]} for row in rows.tolist()]
+
+class ActivityStore:
+	""" Activity series for every camera, keyed by camera id """
+	def __init__(self, capacity=2880, window_size=5):
+		self.capacity = capacity
+		self.window_size = window_size
+		self.series = dict()
+		self.lock = threading.Lock()
+
+	def record(self, cam_id, timestamp, value):
+		""" Adds an activity value for a camera """
+		series = self.series.get(cam_id)
+		if(series == None):
+			with self.lock:
+				series = self.series.setdefault(cam_id, ActivitySeries(self.capacity, self.window_size))
+		series.add_point(timestamp, value)
+
+	def query(self, cam_id, start, end, resolution="raw"):
+		""" Returns the activity of a camera in [start, end], an empty list if nothing is recorded """
+		series = self.series.get(cam_id)
+		if(series == None):
+			return list()
+		return series.query(start, end, resolution)
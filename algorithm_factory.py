@@ -1,45 +1,185 @@
 import cv2
 import numpy as np
+import weakref
+import metrics
+
+def array_bytes(values):
+	""" Total size of the NumPy arrays in values, including arrays in nested lists and tuples """
+	total = 0
+	for value in values:
+		if(isinstance(value, np.ndarray)):
+			total += value.nbytes
+		elif(isinstance(value, (list, tuple))):
+			total += array_bytes(value)
+	return total
 
 class Algorithm:
 	""" The "none" algorithm, does nothing """
 	name = "None"
 	description = "Algorithm that does nothing"
 	id = "none"
+	# Relative processing cost per frame, used to list the cheap algorithms first
+	cost = 0
+	# True if the activity of a frame depends on more than the previous frame
+	stateful = False
 	def __init__(self, sensitivity=30):
+		self.sensitivity = sensitivity
+		self.keypoints = list()
+
+	def reset(self):
+		""" Forgets everything learned from earlier frames """
 		self.keypoints = list()
 
 	def process(self, cur_image, prev_image=False):
 		""" Method that does any processing, none in this case """
 		return cur_image
 
+	def get_activity(self):
+		""" The activity level found by the last call to process """
+		return len(self.keypoints)
+
+	def get_points(self):
+		""" The (x, y) positions of the activity found by the last call to process, as an N x 2 array, used to count activity per zone """
+		return np.array([keypoint.pt for keypoint in self.keypoints], dtype=np.float32).reshape(-1, 2)
+
+	def memory_usage(self):
+		""" Bytes used by the arrays the algorithm keeps between frames """
+		return array_bytes(vars(self).values())
+
 class TrafficAlg(Algorithm):
 	""" Traffic algorithm, for detecting traffic level """
 	name = "Traffic algorithm"
 	description = "Algorithm for detecting traffic using SIFT"
 	id = "traffic"
+	cost = 10
 	def __init__(self, sensitivity=30):
 		""" Initializes the engine used """
 		Algorithm.__init__(self)
 		self.sensitivity = sensitivity
 		self.engine = cv2.BRISK(sensitivity)
 		self.keypoints = list()
+		# Two [weak reference to the source frame, equalized grayscale] slots, so the previous frame is only preprocessed once
+		# The reference is weak, so a slot does not keep a frame (possibly a shared full frame) alive after its camera drops it
+		self.slots = [[None, None], [None, None]]
+		# Reused between calls for the thresholded difference
+		self.diff_image = None
+
+	def reset(self):
+		self.keypoints = list()
+		self.slots = [[None, None], [None, None]]
 
 	def process(self, cur_image, prev_image=False):
 		""" Generates a diff between two images, and does keypoint detection on that """
-		# EqualizeHist enhances contrast, we use a grayscale version of the image
-		image = cv2.equalizeHist(cv2.cvtColor(cur_image, cv2.COLOR_BGR2GRAY))
-		if(not isinstance(prev_image, np.ndarray)):
-			# If there's no previous image, stop processing here
-			return image
-		# Equalize the previous image as well
-		last_image = cv2.equalizeHist(cv2.cvtColor(prev_image, cv2.COLOR_BGR2GRAY))
-		# Get the difference between the two images, using a threshold, values found through experimentation
-		(ret,diff_image) = cv2.threshold(cv2.absdiff(image, last_image), 50, 255, cv2.THRESH_TOZERO)
-		# Call the detection algorithm, and save the detected keypoints
-		self.keypoints = self.engine.detect(diff_image)
-		# Returns the processed image
-		return cv2.drawKeypoints(diff_image, self.keypoints)
+		has_prev = isinstance(prev_image, np.ndarray)
+		with metrics.algorithm_timer(self.id, "preprocess"):
+			prev_slot = self._find_slot(prev_image) if has_prev else None
+			cur_slot = self._find_slot(cur_image)
+			if(cur_slot == None):
+				cur_slot = self.slots[1] if self.slots[0] is prev_slot else self.slots[0]
+				self._preprocess(cur_slot, cur_image)
+			if(not has_prev):
+				# If there's no previous image, stop processing here
+				return cur_slot[1].copy()
+			if(prev_slot == None):
+				prev_slot = self.slots[1] if self.slots[0] is cur_slot else self.slots[0]
+				self._preprocess(prev_slot, prev_image)
+		(image, last_image) = (cur_slot[1], prev_slot[1])
+		if(self.diff_image is None or self.diff_image.shape != image.shape):
+			self.diff_image = np.empty_like(image)
+		with metrics.algorithm_timer(self.id, "diff"):
+			# Get the difference between the two images, using a threshold, values found through experimentation
+			cv2.absdiff(image, last_image, self.diff_image)
+			cv2.threshold(self.diff_image, 50, 255, cv2.THRESH_TOZERO, self.diff_image)
+		with metrics.algorithm_timer(self.id, "detect"):
+			# Call the detection algorithm, and save the detected keypoints
+			self.keypoints = self.engine.detect(self.diff_image)
+		with metrics.algorithm_timer(self.id, "draw"):
+			# Returns the processed image
+			return cv2.drawKeypoints(self.diff_image, self.keypoints)
+
+	def _find_slot(self, image):
+		""" Returns the slot holding the preprocessed version of this exact frame, if any """
+		for slot in self.slots:
+			if(slot[0] != None and slot[0]() is image):
+				return slot
+		return None
+
+	def _preprocess(self, slot, image):
+		""" EqualizeHist enhances contrast, we use a grayscale version of the image, written into the slot's buffer """
+		size = image.shape[:2]
+		if(slot[1] is None or slot[1].shape != size):
+			slot[1] = np.empty(size, dtype=np.uint8)
+		if(image.ndim == 3):
+			cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, slot[1])
+		else:
+			slot[1][...] = image
+		cv2.equalizeHist(slot[1], slot[1])
+		slot[0] = weakref.ref(image)
+
+class BackgroundAlg(Algorithm):
+	""" Background subtraction algorithm, counts moving blobs against a running average of the scene """
+	name = "Background subtraction"
+	description = "Algorithm counting moving objects against a running average background, much cheaper than keypoint detection"
+	id = "background"
+	cost = 1
+	stateful = True
+	def __init__(self, sensitivity=30, learning_rate=0.05, min_area=20):
+		""" sensitivity is the difference from the background for a pixel to be foreground, higher is less sensitive """
+		Algorithm.__init__(self)
+		self.sensitivity = sensitivity
+		self.learning_rate = learning_rate
+		self.min_area = min_area
+		self.blobs = list()
+		# The background model, updated a little with every frame
+		self.background = None
+		# Reused between calls
+		self.gray = None
+		self.background_image = None
+		self.foreground = None
+
+	def reset(self):
+		self.blobs = list()
+		self.background = None
+
+	def process(self, cur_image, prev_image=False):
+		""" Finds the foreground by comparing to the background model, then updates the model with the frame """
+		size = cur_image.shape[:2]
+		with metrics.algorithm_timer(self.id, "preprocess"):
+			if(self.gray is None or self.gray.shape != size):
+				self.gray = np.empty(size, dtype=np.uint8)
+				self.background_image = np.empty(size, dtype=np.uint8)
+				self.foreground = np.empty(size, dtype=np.uint8)
+				self.background = None
+			if(cur_image.ndim == 3):
+				cv2.cvtColor(cur_image, cv2.COLOR_BGR2GRAY, self.gray)
+			else:
+				self.gray[...] = cur_image
+		if(self.background is None):
+			# The first frame is all background
+			self.background = self.gray.astype(np.float32)
+			self.blobs = list()
+			return self.gray.copy()
+		with metrics.algorithm_timer(self.id, "subtract"):
+			cv2.convertScaleAbs(self.background, self.background_image)
+			cv2.absdiff(self.gray, self.background_image, self.foreground)
+			cv2.threshold(self.foreground, self.sensitivity, 255, cv2.THRESH_BINARY, self.foreground)
+			cv2.accumulateWeighted(self.gray, self.background, self.learning_rate)
+		with metrics.algorithm_timer(self.id, "blobs"):
+			# findContours modifies its input in older OpenCV versions, the contours are the second to last value in all of them
+			contours = cv2.findContours(self.foreground.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+			self.blobs = [contour for contour in contours if cv2.contourArea(contour) >= self.min_area]
+		with metrics.algorithm_timer(self.id, "draw"):
+			output = cv2.cvtColor(self.foreground, cv2.COLOR_GRAY2BGR)
+			cv2.drawContours(output, self.blobs, -1, (0, 0, 255), 1)
+		return output
+
+	def get_activity(self):
+		""" The number of moving blobs in the last frame """
+		return len(self.blobs)
+
+	def get_points(self):
+		""" The centres of the moving blobs in the last frame """
+		return np.array([contour.reshape(-1, 2).mean(axis=0) for contour in self.blobs], dtype=np.float32).reshape(-1, 2)
 
 class Factory():
 	"""
@@ -48,30 +188,37 @@ class Factory():
 	"""
 	algs = dict()
 	algs["traffic"] = TrafficAlg
+	algs["background"] = BackgroundAlg
 	algs["none"] = Algorithm
 	
 	@staticmethod
-	def get_alg(alg):
+	def get_alg(alg, sensitivity=30):
 		""" Returns the algorithm matching the given input, the "none" algorithm if the given algorithm is not found """
 		if(alg in Factory.algs):
-			return Factory.algs[alg]()
+			return Factory.algs[alg](sensitivity)
 		else:
-			return Factory.algs["none"]()
+			return Factory.algs["none"](sensitivity)
+	
+	@staticmethod
+	def by_cost():
+		""" Returns a list of (algorithm_id, algorithm class), cheapest first """
+		return sorted(Factory.algs.items(), key=lambda element: (element[1].cost, element[0]))
 	
 	@staticmethod
 	def __str__():
 		""" Simple string representation of the algorithm factory """
 		retString = "Algorithm factory containing algs: \n"
-		for key in Factory.algs:
-			retString += Factory.algs[key].description + "\n"
+		for (key, alg) in Factory.by_cost():
+			retString += alg.description + " (relative cost " + str(alg.cost) + ")\n"
 		return retString
 	
 	@staticmethod
 	def get_printable():
-		""" Returns a dict with the following form: output[algorithm_id] = (algorithm_name, algorithm_description) """
+		""" Returns a dict with the following form: output[algorithm_id] = (algorithm_name, algorithm_description, relative_cost) """
 		printable = dict()
 		for key in Factory.algs:
-			printable[key] = (Factory.algs[key].name, Factory.algs[key].description)
+			printable[key] = (Factory.algs[key].name, Factory.algs[key].description, Factory.algs[key].cost)
+		return printable
 
 if __name__ == "__main__":
 	fac = Factory()
@@ -0,0 +1,265 @@
+import argparse
+import BaseHTTPServer
+import SocketServer
+import json
+import os
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import cv2
+import numpy as np
+from algorithm_factory import Factory as algFac
+from frame_fetcher import Fetcher, decode_image
+import trafficmon_service as tf
+
+def synthetic_frames(width, height, count, seed=0):
+	""" Generates count colour frames of a noisy road with a few rectangular "cars" moving across it """
+	random = np.random.RandomState(seed)
+	background = random.randint(60, 120, (height, width, 3)).astype(np.uint8)
+	cars = [(random.randint(0, width), random.randint(0, height - 20), random.randint(5, 20)) for i in range(8)]
+	frames = list()
+	for i in range(count):
+		frame = background.copy()
+		for (x, y, speed) in cars:
+			x = (x + speed * i) % width
+			cv2.rectangle(frame, (x, y), (x + 30, y + 15), (200, 200, 200), -1)
+		frames.append(frame)
+	return frames
+
+def recorded_frames(directory):
+	""" Loads a recorded sequence of JPEG files, in name order """
+	frames = list()
+	for name in sorted(os.listdir(directory)):
+		if(name.lower().endswith((".jpg", ".jpeg"))):
+			with open(os.path.join(directory, name), "rb") as handle:
+				frames.append(handle.read())
+	return frames
+
+class FrameHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""
+		Serves /cam/<n>.jpg as a stand-in webcam, each camera publishes a new frame change_rate times per second
+		Every camera is offset in the sequence, and ETags are sent so conditional GETs can be answered with 304
+	"""
+	protocol_version = "HTTP/1.1"
+
+	def do_GET(self):
+		try:
+			cam = int(self.path.split("/")[-1].split(".")[0])
+		except ValueError:
+			self.send_error(404)
+			return
+		server = self.server
+		index = (int(time.time() * server.change_rate) + cam) % len(server.frames)
+		etag = '"' + str(index) + '"'
+		if(self.headers.get("If-None-Match") == etag):
+			self.send_response(304)
+			self.send_header("ETag", etag)
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+			return
+		body = server.frames[index]
+		self.send_response(200)
+		self.send_header("Content-Type", "image/jpeg")
+		self.send_header("ETag", etag)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+class FrameServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	""" Local HTTP server standing in for real webcams, runs in a background thread """
+	daemon_threads = True
+
+	def __init__(self, frames, change_rate=1.0):
+		""" frames is a list of JPEG encoded frames, change_rate is new frames per second """
+		BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), FrameHandler)
+		self.frames = frames
+		self.change_rate = change_rate
+		self.thread = threading.Thread(target=self.serve_forever)
+		self.thread.daemon = True
+		# Open client connections, clients keep them alive between fetches, so stop() has to close them
+		self.connections = set()
+		self.connections_lock = threading.Lock()
+
+	def start(self):
+		self.thread.start()
+		return self
+
+	def stop(self):
+		""" Stops serving, and closes the kept alive connections so their handler threads exit """
+		self.shutdown()
+		self.server_close()
+		with self.connections_lock:
+			connections = list(self.connections)
+		for connection in connections:
+			try:
+				connection.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				# Already closed by the client
+				pass
+
+	def process_request_thread(self, request, client_address):
+		with self.connections_lock:
+			self.connections.add(request)
+		try:
+			SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+		finally:
+			with self.connections_lock:
+				self.connections.discard(request)
+
+	def url(self, cam):
+		""" The url of stand-in camera number cam """
+		return "http://127.0.0.1:" + str(self.server_address[1]) + "/cam/" + str(cam) + ".jpg"
+
+def encode_frames(frames, quality=85):
+	""" JPEG encodes a list of frames """
+	return [cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tostring() for frame in frames]
+
+def percentiles(samples):
+	""" Summary of a list of latencies in seconds, as milliseconds """
+	if(not samples):
+		return None
+	samples = np.array(samples) * 1000.0
+	return {
+		"count": len(samples),
+		"mean_ms": float(samples.mean()),
+		"p50_ms": float(np.percentile(samples, 50)),
+		"p90_ms": float(np.percentile(samples, 90)),
+		"p99_ms": float(np.percentile(samples, 99)),
+		"max_ms": float(samples.max()),
+	}
+
+def stateless_process(engine, cur_image, prev_image):
+	""" The original TrafficAlg pipeline, preprocessing both frames on every call, returns (keypoints, thresholded difference, processed image) """
+	image = cv2.equalizeHist(cv2.cvtColor(cur_image, cv2.COLOR_BGR2GRAY))
+	last_image = cv2.equalizeHist(cv2.cvtColor(prev_image, cv2.COLOR_BGR2GRAY))
+	(ret, diff_image) = cv2.threshold(cv2.absdiff(image, last_image), 50, 255, cv2.THRESH_TOZERO)
+	keypoints = engine.detect(diff_image)
+	return (keypoints, diff_image, cv2.drawKeypoints(diff_image, keypoints))
+
+def bench_algorithm(width, height, count):
+	""" Returns the average per-frame cost in milliseconds of the stateless and the stateful traffic algorithm """
+	frames = synthetic_frames(width, height, count)
+	engine = cv2.BRISK(30)
+	start = time.time()
+	for i in range(1, count):
+		stateless_process(engine, frames[i], frames[i - 1])
+	stateless = (time.time() - start) * 1000.0 / (count - 1)
+
+	alg = algFac.get_alg("traffic")
+	alg.process(frames[0])
+	start = time.time()
+	for i in range(1, count):
+		alg.process(frames[i], frames[i - 1])
+	stateful = (time.time() - start) * 1000.0 / (count - 1)
+	return (stateless, stateful)
+
+def bench_stages(server, cameras, rounds, algorithm):
+	""" Runs fetch, decode, process and encode for every camera, rounds times, returns latency summaries per stage """
+	fetcher = Fetcher()
+	algs = [algFac.get_alg(algorithm) for i in range(cameras)]
+	previous = [False] * cameras
+	stages = {"fetch": list(), "decode": list(), "process": list(), "encode": list()}
+	for i in range(rounds):
+		for cam in range(cameras):
+			start = time.time()
+			response = fetcher.fetch(server.url(cam))
+			fetched = time.time()
+			image = decode_image(response.body, grayscale=True)
+			decoded = time.time()
+			processed = algs[cam].process(image, previous[cam])
+			done = time.time()
+			cv2.imencode(".png", processed)
+			encoded = time.time()
+			previous[cam] = image
+			stages["fetch"].append(fetched - start)
+			stages["decode"].append(decoded - fetched)
+			stages["process"].append(done - decoded)
+			stages["encode"].append(encoded - done)
+	fetcher.close()
+	return dict((stage, percentiles(samples)) for (stage, samples) in stages.items())
+
+def bench_manager(server, cameras, duration, workers, processes, algorithm):
+	""" Registers cameras with a Manager and refreshes them continuously for duration seconds, returns cameras/second """
+	directory = tempfile.mkdtemp()
+	try:
+		manager = tf.Manager(os.path.join(directory, "bench"), processes=processes)
+		for cam in range(cameras):
+			cam_id = str(manager.add_camera("Camera " + str(cam), server.url(cam), algorithm=algorithm))
+			# Due again as soon as it is done, so the workers never idle
+			manager.cameras[cam_id].current_interval = 0.0
+		scheduler = manager.start_scheduler(workers)
+		start = time.time()
+		time.sleep(duration)
+		stats = scheduler.stats()
+		elapsed = time.time() - start
+		manager.close()
+	finally:
+		shutil.rmtree(directory)
+	return {
+		"cameras": cameras,
+		"workers": workers,
+		"processes": processes,
+		"refreshes": stats["completed"],
+		"failed": stats["failed"],
+		"cameras_per_second": stats["completed"] / elapsed,
+		"max_lag": stats["max_lag"],
+	}
+
+def peak_rss():
+	""" Peak resident set size of this process in bytes """
+	usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Reported in kilobytes on Linux, bytes on OS X
+	if(sys.platform == "darwin"):
+		return usage
+	return usage * 1024
+
+def run(args):
+	""" Runs all benchmarks, returns the results as a dict """
+	if(args.recorded):
+		frames = recorded_frames(args.recorded)
+	else:
+		frames = encode_frames(synthetic_frames(args.width, args.height, args.frames))
+	server = FrameServer(frames, args.change_rate).start()
+	try:
+		results = {
+			"timestamp": time.time(),
+			"config": vars(args),
+			"stages": bench_stages(server, args.cameras, args.rounds, args.algorithm),
+			"manager": bench_manager(server, args.cameras, args.duration, args.workers, args.processes, args.algorithm),
+		}
+	finally:
+		server.stop()
+	(stateless, stateful) = bench_algorithm(args.width, args.height, args.frames)
+	results["algorithm"] = {"stateless_ms_per_frame": stateless, "stateful_ms_per_frame": stateful}
+	results["peak_rss_bytes"] = peak_rss()
+	return results
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="TrafficMonitor benchmarks, using a local stand-in camera server")
+	parser.add_argument("--cameras", type=int, default=20, help="Number of cameras")
+	parser.add_argument("--width", type=int, default=640)
+	parser.add_argument("--height", type=int, default=480)
+	parser.add_argument("--frames", type=int, default=50, help="Length of the synthetic frame sequence")
+	parser.add_argument("--recorded", help="Directory of JPEG files to serve instead of synthetic frames")
+	parser.add_argument("--change-rate", type=float, default=1.0, help="New frames published per second by each camera")
+	parser.add_argument("--rounds", type=int, default=5, help="Rounds over all cameras for the per-stage timings")
+	parser.add_argument("--duration", type=float, default=10.0, help="Seconds to run the Manager throughput benchmark")
+	parser.add_argument("--workers", type=int, default=4, help="Scheduler threads for the Manager benchmark")
+	parser.add_argument("--processes", type=int, default=0, help="Algorithm worker processes for the Manager benchmark")
+	parser.add_argument("--algorithm", default="traffic")
+	parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+	args = parser.parse_args()
+
+	results = json.dumps(run(args), indent=2, sort_keys=True)
+	if(args.output):
+		with open(args.output, "w") as handle:
+			handle.write(results)
+	else:
+		print(results)
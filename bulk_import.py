@@ -0,0 +1,144 @@
+import argparse
+import csv
+import json
+import re
+import threading
+import urlparse
+import Queue
+from StringIO import StringIO
+from algorithm_factory import Factory as algFac
+from frame_fetcher import Fetcher, decode_image
+from zones import parse_zones
+
+# Columns of a CSV import, only name and url are required
+COLUMNS = ("name", "url", "lat", "lon", "subset", "algorithm", "interval", "zones")
+
+def parse_rows(data, fmt):
+	""" Parses an import file, fmt is "csv" (with a header row) or "json" (a list of objects), returns a list of dicts """
+	if(fmt == "csv"):
+		return [dict((key.strip(), value) for (key, value) in row.items() if key) for row in csv.DictReader(StringIO(data))]
+	if(fmt == "json"):
+		rows = json.loads(data)
+		if(isinstance(rows, dict)):
+			rows = rows.get("cameras", list())
+		if(not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows)):
+			raise ValueError("Expected a list of cameras")
+		return rows
+	raise ValueError("Unknown import format: " + str(fmt))
+
+def parse_subset(value):
+	""" Parses a subset given as [[x0, x1], [y0, y1]] or as four numbers, returns ((x0, x1), (y0, y1)) or None """
+	if(value in (None, "", [])):
+		return None
+	numbers = [int(number) for number in re.findall(r"-?\d+", json.dumps(value) if not isinstance(value, basestring) else value)]
+	if(len(numbers) != 4):
+		raise ValueError("Subset must be four numbers, x0 x1 y0 y1")
+	(x0, x1, y0, y1) = numbers
+	if(x0 < 0 or y0 < 0 or x1 <= x0 or y1 <= y0):
+		raise ValueError("Subset is empty or negative")
+	return ((x0, x1), (y0, y1))
+
+def validate_row(row):
+	""" Checks the fields of a row, returns a normalized dict, raises ValueError describing the first problem """
+	name = (row.get("name") or "").strip()
+	url = (row.get("url") or "").strip()
+	if(not name):
+		raise ValueError("Missing name")
+	if(urlparse.urlsplit(url).scheme not in ("http", "https") or not urlparse.urlsplit(url).netloc):
+		raise ValueError("Invalid url: " + url)
+	algorithm = (row.get("algorithm") or "none").strip()
+	if(algorithm not in algFac.algs):
+		raise ValueError("Unknown algorithm: " + algorithm)
+	(lat, lon) = (row.get("lat"), row.get("lon"))
+	if(lat in (None, "") or lon in (None, "")):
+		(lat, lon) = (None, None)
+	else:
+		(lat, lon) = (float(lat), float(lon))
+		if(not -90.0 <= lat <= 90.0 or not -180.0 <= lon <= 180.0):
+			raise ValueError("Location out of range")
+	interval = row.get("interval")
+	interval = 30.0 if interval in (None, "") else float(interval)
+	if(interval <= 0):
+		raise ValueError("Interval must be positive")
+	return {"name": name, "url": url, "lat": lat, "lon": lon, "subset": parse_subset(row.get("subset")), "algorithm": algorithm, "interval": interval, "zones": parse_zones(row.get("zones"))}
+
+def check_camera(fetcher, record):
+	""" Fetches and decodes a camera's image, and checks that the subset fits, raises FetchError or ValueError """
+	image = decode_image(fetcher.fetch(record["url"]).body, grayscale=True)
+	subset = record["subset"]
+	if(subset and (subset[0][1] > image.shape[1] or subset[1][1] > image.shape[0])):
+		raise ValueError("Subset outside the " + str(image.shape[1]) + "x" + str(image.shape[0]) + " image")
+
+def validate(rows, workers=16, timeout=5.0):
+	"""
+		Validates rows, fetching every camera once with up to workers concurrent requests of at most timeout seconds
+		Returns (accepted, failed), accepted is a list of (row number, record) and failed a list of dicts with the row number and error
+		Row numbers start at 1 and follow the input order
+	"""
+	accepted = list()
+	failed = list()
+	jobs = Queue.Queue()
+	for (number, row) in enumerate(rows, 1):
+		try:
+			jobs.put((number, validate_row(row)))
+		except (ValueError, TypeError, AttributeError) as e:
+			failed.append({"row": number, "name": row.get("name"), "error": str(e)})
+	lock = threading.Lock()
+
+	def check():
+		""" Worker thread, with its own connection pool """
+		fetcher = Fetcher(timeout=timeout)
+		while True:
+			try:
+				(number, record) = jobs.get_nowait()
+			except Queue.Empty:
+				break
+			try:
+				check_camera(fetcher, record)
+				with lock:
+					accepted.append((number, record))
+			except Exception as e:
+				with lock:
+					failed.append({"row": number, "name": record["name"], "error": str(e)})
+		fetcher.close()
+
+	threads = [threading.Thread(target=check, name="import-check-" + str(i)) for i in range(min(workers, jobs.qsize()))]
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return (sorted(accepted), sorted(failed, key=lambda failure: failure["row"]))
+
+def import_cameras(manager, rows, workers=16, timeout=5.0):
+	"""
+		Validates rows and adds the accepted cameras to manager, stored in a single storage transaction
+		Returns a dict with the accepted rows and their camera ids, and the failed rows with their errors
+	"""
+	(accepted, failed) = validate(rows, workers, timeout)
+	cam_ids = manager.add_cameras([record for (number, record) in accepted])
+	return {
+		"accepted": [{"row": number, "name": record["name"], "cam_id": cam_id} for ((number, record), cam_id) in zip(accepted, cam_ids)],
+		"failed": failed,
+	}
+
+if __name__ == "__main__":
+	import trafficmon_service as tf
+	parser = argparse.ArgumentParser(description="Imports cameras from a CSV or JSON file, with the columns " + ", ".join(COLUMNS))
+	parser.add_argument("file", help="CSV file with a header row, or a JSON list of cameras")
+	parser.add_argument("--format", choices=["csv", "json"], help="Defaults to the file extension")
+	parser.add_argument("--database", default="default", help="Database name, as passed to Manager")
+	parser.add_argument("--storage", default="gdbm", help="Storage backend, gdbm or sqlite")
+	parser.add_argument("--workers", type=int, default=16, help="Number of cameras checked at the same time")
+	parser.add_argument("--timeout", type=float, default=5.0, help="Seconds to wait for each camera")
+	args = parser.parse_args()
+
+	fmt = args.format or ("json" if args.file.lower().endswith(".json") else "csv")
+	with open(args.file) as handle:
+		rows = parse_rows(handle.read(), fmt)
+	manager = tf.Manager(args.database, backend=args.storage)
+	result = import_cameras(manager, rows, args.workers, args.timeout)
+	manager.close()
+	for failure in result["failed"]:
+		print("Row " + str(failure["row"]) + " (" + str(failure["name"]) + "): " + failure["error"])
+	print("Imported " + str(len(result["accepted"])) + " cameras, " + str(len(result["failed"])) + " rows failed")
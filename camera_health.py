@@ -0,0 +1,79 @@
+import threading
+import time
+
+HEALTHY = "healthy"
+# Failed recently, retried after a backoff
+FAILING = "failing"
+# Circuit breaker open, not fetched at all until the next probe
+OPEN = "open"
+# Probing an open camera, one success closes the circuit, one failure opens it again
+HALF_OPEN = "half-open"
+
+class CameraHealth:
+	"""
+		Health state machine of a camera, decides when it may be fetched
+		Failures are retried with exponential backoff, and after failure_threshold failures in a row the circuit opens,
+		the camera is then only probed once per backoff period (up to max_backoff) until a probe succeeds
+	"""
+	def __init__(self, failure_threshold=3, base_backoff=5.0, max_backoff=600.0, multiplier=2.0):
+		self.failure_threshold = failure_threshold
+		self.base_backoff = base_backoff
+		self.max_backoff = max_backoff
+		self.multiplier = multiplier
+		self.state = HEALTHY
+		self.failures = 0
+		self.retry_at = 0.0
+		self.last_error = None
+		self.last_success = None
+		self.lock = threading.Lock()
+
+	def allow(self, now=None):
+		""" True if the camera may be fetched now, an open circuit becomes half-open and allows a single probe when it is due """
+		now = time.time() if now == None else now
+		with self.lock:
+			if(self.state == HEALTHY or now >= self.retry_at and self.state != OPEN):
+				return True
+			if(self.state == OPEN and now >= self.retry_at):
+				# Only this caller probes, others wait for its result, or for another backoff if it never reports one
+				self.state = HALF_OPEN
+				self.retry_at = now + self._backoff()
+				return True
+			return False
+
+	def record_success(self, now=None):
+		with self.lock:
+			self.state = HEALTHY
+			self.failures = 0
+			self.retry_at = 0.0
+			self.last_success = time.time() if now == None else now
+
+	def record_failure(self, error, now=None):
+		""" Counts a failed fetch, and schedules the next attempt """
+		now = time.time() if now == None else now
+		with self.lock:
+			self.failures += 1
+			self.last_error = str(error)
+			self.retry_at = now + self._backoff()
+			if(self.state == HALF_OPEN or self.failures >= self.failure_threshold):
+				self.state = OPEN
+			else:
+				self.state = FAILING
+
+	def _backoff(self):
+		""" Delay before the next attempt after the current number of failures in a row, called with the lock held """
+		return min(self.base_backoff * self.multiplier ** (self.failures - 1), self.max_backoff)
+
+	def next_attempt(self):
+		""" Earliest time the camera may be fetched again, 0 if it may be fetched at any time """
+		with self.lock:
+			return self.retry_at if self.state != HEALTHY else 0.0
+
+	def stats(self):
+		with self.lock:
+			return {
+				"state": self.state,
+				"failures": self.failures,
+				"retry_at": self.retry_at if self.state != HEALTHY else None,
+				"last_error": self.last_error,
+				"last_success": self.last_success,
+			}
@@ -0,0 +1,194 @@
+import heapq
+import threading
+import time
+import Queue
+
+class Scheduler:
+	"""
+		Refreshes cameras in the background, so requests only read the latest results
+		Cameras are kept in a heap ordered by when they are due (last_updated + update_interval),
+		and a fixed number of worker threads pop and refresh them
+	"""
+	def __init__(self, manager, workers=4):
+		""" manager is the Manager owning the cameras, workers is the size of the refresh pool """
+		self.manager = manager
+		self.workers = workers
+		self.heap = list()
+		# The deadline each camera is currently scheduled at, heap entries not matching this are stale
+		self.deadlines = dict()
+		self.condition = threading.Condition()
+		self.threads = list()
+		self.running = False
+		self.active = 0
+		self.completed = 0
+		self.failed = 0
+		self.last_lag = 0.0
+		self.max_lag = 0.0
+		self.warming_up = 0
+
+	def start(self, warmup_workers=0):
+		""" 
+			Schedules every known camera, and starts the worker threads
+			If warmup_workers is set, cameras that have not been fetched yet are first fetched by that many
+			separate threads, and are only scheduled once fetched
+		"""
+		warmup = Queue.Queue()
+		for cam_id in list(self.manager.cameras.keys()):
+			if(warmup_workers and not self.manager.cameras[cam_id].fetched):
+				warmup.put(cam_id)
+			else:
+				self.schedule(cam_id)
+		self.warming_up = warmup.qsize()
+		self.running = True
+		for i in range(min(warmup_workers, warmup.qsize())):
+			worker = threading.Thread(target=self._warm_up, args=(warmup,), name="camera-warmup-" + str(i))
+			worker.daemon = True
+			worker.start()
+			self.threads.append(worker)
+		for i in range(self.workers):
+			worker = threading.Thread(target=self._work, name="camera-refresh-" + str(i))
+			worker.daemon = True
+			worker.start()
+			self.threads.append(worker)
+
+	def stop(self):
+		""" Stops the worker and warm up threads, refreshes in progress are allowed to finish """
+		with self.condition:
+			self.running = False
+			self.condition.notify_all()
+		for worker in self.threads:
+			worker.join()
+		self.threads = list()
+
+	def schedule(self, cam_id, deadline=None):
+		""" Schedules a camera for refresh at deadline, defaults to when the camera is next due """
+		if(deadline == None):
+			deadline = self.manager.next_update(cam_id)
+		with self.condition:
+			self.deadlines[cam_id] = deadline
+			heapq.heappush(self.heap, (deadline, cam_id))
+			self.condition.notify()
+
+	def stats(self):
+		""" Returns a dict with queue depth and lag, lag is how far behind schedule the refreshes are """
+		now = time.time()
+		with self.condition:
+			overdue = [now - deadline for deadline in self.deadlines.values() if deadline <= now]
+			return {
+				"workers": self.workers,
+				"scheduled": len(self.deadlines),
+				"queue_depth": len(overdue),
+				"active": self.active,
+				"completed": self.completed,
+				"failed": self.failed,
+				"current_lag": max(overdue) if overdue else 0.0,
+				"last_lag": self.last_lag,
+				"max_lag": self.max_lag,
+				"warming_up": self.warming_up,
+			}
+
+	def _warm_up(self, warmup):
+		""" Warm up thread, fetches cameras for the first time and hands them over to the scheduler, until stopped """
+		while self.running:
+			try:
+				cam_id = warmup.get_nowait()
+			except Queue.Empty:
+				return
+			try:
+				self.manager.refresh_camera(cam_id)
+			except Exception as e:
+				# Retried by the scheduler, when it is next due
+				print("Error fetching camera " + str(cam_id) + ": " + str(e))
+			with self.condition:
+				self.warming_up -= 1
+				if(not self.running):
+					return
+			self.schedule(cam_id)
+
+	def _next_job(self):
+		""" Blocks until a camera is due, returns (cam_id, lag), or None when stopping """
+		with self.condition:
+			while self.running:
+				now = time.time()
+				if(not self.heap):
+					self.condition.wait()
+					continue
+				(deadline, cam_id) = self.heap[0]
+				if(self.deadlines.get(cam_id) != deadline):
+					# Rescheduled since it was pushed
+					heapq.heappop(self.heap)
+					continue
+				if(deadline > now):
+					self.condition.wait(deadline - now)
+					continue
+				heapq.heappop(self.heap)
+				del self.deadlines[cam_id]
+				self.active += 1
+				return (cam_id, now - deadline)
+			return None
+
+	def _work(self):
+		""" Worker loop, refreshes due cameras and puts them back in the heap """
+		while True:
+			job = self._next_job()
+			if(job == None):
+				return
+			(cam_id, lag) = job
+			failed = False
+			try:
+				self.manager.refresh_camera(cam_id)
+			except Exception as e:
+				# A single broken camera should not take down the worker
+				failed = True
+				print("Error refreshing camera " + str(cam_id) + ": " + str(e))
+			with self.condition:
+				self.active -= 1
+				self.completed += 1
+				if(failed):
+					self.failed += 1
+				self.last_lag = lag
+				self.max_lag = max(self.max_lag, lag)
+			if(cam_id in self.manager.cameras and cam_id not in self.deadlines):
+				self.schedule(cam_id)
+
+class AdaptiveInterval:
+	"""
+		Adapts the refresh interval of cameras to how often they publish new frames, and how busy they are
+		Cameras are polled about twice per observed publish period, unchanged or quiet cameras are backed off,
+		and cameras where the activity rises are polled more often, always within [min_interval, max_interval]
+	"""
+	def __init__(self, min_interval=5.0, max_interval=600.0, backoff=1.5, smoothing=0.3, rise=1.5):
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		self.backoff = backoff
+		self.smoothing = smoothing
+		self.rise = rise
+
+	def next_interval(self, camera, changed, now):
+		""" Returns the new interval for a camera, after a refresh that did or did not produce a new frame """
+		interval = camera.current_interval
+		if(not changed):
+			interval *= self.backoff
+		else:
+			if(camera.last_change != None):
+				observed = now - camera.last_change
+				if(camera.cadence == None):
+					camera.cadence = observed
+				else:
+					camera.cadence += self.smoothing * (observed - camera.cadence)
+				# Poll about twice per publish period, so new frames are picked up soon after they appear
+				interval = camera.cadence / 2.0
+			camera.last_change = now
+			activity = float(camera.activity)
+			average = camera.activity_average
+			if(average != None and activity > 0 and activity > average * self.rise):
+				# Traffic is picking up
+				interval = min(interval, camera.current_interval) / 2.0
+			elif(average != None and activity * self.rise < average):
+				# Quiet compared to usual, no need to hurry
+				interval = max(interval, camera.current_interval * self.backoff)
+			if(average == None):
+				camera.activity_average = activity
+			else:
+				camera.activity_average += self.smoothing * (activity - average)
+		return min(max(interval, self.min_interval), self.max_interval)
@@ -0,0 +1,142 @@
+import httplib
+import socket
+import threading
+import urllib2
+import urlparse
+import cv2
+import numpy as np
+
+class FetchError(IOError):
+	""" Raised when an image could not be fetched from a camera """
+	pass
+
+class Response:
+	""" The result of a fetch, body is None if the camera has not published a new frame """
+	def __init__(self, status, body=None, etag=None, last_modified=None):
+		self.status = status
+		self.body = body
+		self.etag = etag
+		self.last_modified = last_modified
+
+	def not_modified(self):
+		""" True if the server answered 304, so the previous frame is still current """
+		return self.status == httplib.NOT_MODIFIED
+
+class Fetcher:
+	"""
+		Fetches camera images into memory, reusing keep-alive connections per host
+		Sends If-None-Match/If-Modified-Since so unchanged frames are not transferred
+	"""
+	redirects = (httplib.MOVED_PERMANENTLY, httplib.FOUND, httplib.SEE_OTHER, httplib.TEMPORARY_REDIRECT, 308)
+
+	def __init__(self, timeout=10.0, max_idle=4, max_redirects=3, connect_timeout=None):
+		""" 
+			timeout is the longest wait in seconds for data from the camera, connect_timeout (defaults to timeout)
+			the longest wait for a connection, max_idle is the number of idle connections kept per host
+		"""
+		self.timeout = timeout
+		self.connect_timeout = connect_timeout or timeout
+		self.max_idle = max_idle
+		self.max_redirects = max_redirects
+		self.idle = dict()
+		self.lock = threading.Lock()
+
+	def fetch(self, url, etag=None, last_modified=None):
+		""" Fetches url, returning a Response, raises FetchError if the image can not be fetched """
+		for i in range(self.max_redirects + 1):
+			parts = urlparse.urlsplit(url)
+			if(parts.scheme not in ("http", "https")):
+				return self._fetch_other(url)
+			headers = dict()
+			if(etag):
+				headers["If-None-Match"] = etag
+			if(last_modified):
+				headers["If-Modified-Since"] = last_modified
+			path = parts.path or "/"
+			if(parts.query):
+				path += "?" + parts.query
+			(status, response_headers, body) = self._request(parts, path, headers)
+			if(status in self.redirects and "location" in response_headers):
+				url = urlparse.urljoin(url, response_headers["location"])
+				continue
+			if(status == httplib.NOT_MODIFIED):
+				return Response(status, None, etag, last_modified)
+			if(status != httplib.OK):
+				raise FetchError("HTTP " + str(status) + " fetching " + url)
+			return Response(status, body, response_headers.get("etag"), response_headers.get("last-modified"))
+		raise FetchError("Too many redirects fetching " + url)
+
+	def close(self):
+		""" Closes all idle connections """
+		with self.lock:
+			for connections in self.idle.values():
+				for connection in connections:
+					connection.close()
+			self.idle = dict()
+
+	def _request(self, parts, path, headers):
+		""" Does a single GET, retrying once on a fresh connection if a reused one was closed by the server """
+		key = (parts.scheme, parts.netloc)
+		for attempt in range(2):
+			(connection, reused) = self._get_connection(key)
+			try:
+				if(connection.sock == None):
+					connection.connect()
+					connection.sock.settimeout(self.timeout)
+				connection.request("GET", path, headers=headers)
+				response = connection.getresponse()
+				body = response.read()
+			except (httplib.HTTPException, socket.error) as e:
+				connection.close()
+				if(reused and not isinstance(e, socket.timeout)):
+					# Closed by the server while idle, a timeout means the camera itself is not answering
+					continue
+				raise FetchError("Error fetching " + parts.geturl() + ": " + str(e))
+			if(response.will_close):
+				connection.close()
+			else:
+				self._release_connection(key, connection)
+			return (response.status, dict(response.getheaders()), body)
+		raise FetchError("Error fetching " + parts.geturl())
+
+	def _get_connection(self, key):
+		""" Returns (connection, reused), taking an idle connection to the host if there is one """
+		with self.lock:
+			connections = self.idle.get(key)
+			if(connections):
+				return (connections.pop(), True)
+		(scheme, netloc) = key
+		if(scheme == "https"):
+			return (httplib.HTTPSConnection(netloc, timeout=self.connect_timeout), False)
+		return (httplib.HTTPConnection(netloc, timeout=self.connect_timeout), False)
+
+	def _release_connection(self, key, connection):
+		""" Puts a connection back in the pool, or closes it if the pool for the host is full """
+		with self.lock:
+			connections = self.idle.setdefault(key, list())
+			if(len(connections) < self.max_idle):
+				connections.append(connection)
+				return
+		connection.close()
+
+	def _fetch_other(self, url):
+		""" Fallback for non-HTTP urls (such as file://), without connection reuse or validators """
+		try:
+			handle = urllib2.urlopen(url, timeout=self.timeout)
+			try:
+				return Response(httplib.OK, handle.read())
+			finally:
+				handle.close()
+		except IOError as e:
+			raise FetchError("Error fetching " + url + ": " + str(e))
+
+def decode_image(data, grayscale=False):
+	""" Decodes an encoded image straight from memory, raises FetchError if it is not an image """
+	image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR)
+	if(not isinstance(image, np.ndarray)):
+		raise FetchError("Could not decode image")
+	return image
+
+# Shared by all cameras, so connections to the same host are reused between them
+# A camera that does not accept a connection within 3 seconds is most likely down
+default_fetcher = Fetcher(timeout=10.0, connect_timeout=3.0)
@@ -0,0 +1,137 @@
+import argparse
+import os
+import threading
+import numpy as np
+from algorithm_factory import Factory as algFac
+
+# Identifies history files, and the version of the layout below
+MAGIC = 0x54464831
+# Header fields, stored as int64: magic, capacity, height, width, channels, start, count, reserved
+HEADER_FIELDS = 8
+
+class FrameHistory:
+	"""
+		The last capacity frames of a camera (its region of interest) with timestamps, in a memory-mapped ring file
+		The file is a header, then capacity timestamps, then capacity frames, so it never grows,
+		and frames are read from the page cache one at a time instead of being held in memory
+	"""
+	def __init__(self, path, shape, capacity=1000):
+		""" shape is the shape of the frames, the file is recreated if it was written with another shape or capacity """
+		self.path = path
+		self.shape = tuple(shape) if len(shape) == 3 else tuple(shape) + (1,)
+		self.capacity = capacity
+		self.lock = threading.Lock()
+		if(not self._matches()):
+			self._create()
+		self.header = np.memmap(path, dtype=np.int64, mode="r+", shape=(HEADER_FIELDS,))
+		self.timestamps = np.memmap(path, dtype=np.float64, mode="r+", offset=self.header.nbytes, shape=(capacity,))
+		self.frames = np.memmap(path, dtype=np.uint8, mode="r+", offset=self.header.nbytes + self.timestamps.nbytes, shape=(capacity,) + self.shape)
+
+	def _matches(self):
+		""" True if path is a history file with this shape and capacity """
+		if(not os.path.exists(self.path)):
+			return False
+		header = np.fromfile(self.path, dtype=np.int64, count=HEADER_FIELDS)
+		return len(header) == HEADER_FIELDS and tuple(header[:5]) == (MAGIC, self.capacity) + self.shape
+
+	def _create(self):
+		""" Creates an empty history file, replacing any existing one """
+		size = HEADER_FIELDS * 8 + self.capacity * 8 + self.capacity * int(np.prod(self.shape))
+		with open(self.path, "wb") as handle:
+			# Sparse, the blocks are only allocated once frames are written
+			handle.truncate(size)
+		header = np.memmap(self.path, dtype=np.int64, mode="r+", shape=(HEADER_FIELDS,))
+		header[:5] = (MAGIC, self.capacity) + self.shape
+		header.flush()
+		del header
+
+	def __len__(self):
+		return int(self.header[6])
+
+	def append(self, timestamp, frame):
+		""" Stores a frame, overwriting the oldest one when the history is full """
+		frame = frame.reshape(self.shape)
+		with self.lock:
+			(start, count) = (int(self.header[5]), int(self.header[6]))
+			index = (start + count) % self.capacity
+			# Marks the slot as being written, so readers copying it at the same time skip it
+			self.timestamps[index] = np.nan
+			self.frames[index] = frame
+			self.timestamps[index] = timestamp
+			if(count < self.capacity):
+				self.header[6] = count + 1
+			else:
+				self.header[5] = (start + 1) % self.capacity
+
+	def read(self, start=None, end=None):
+		"""
+			Generator of (timestamp, frame) in time order, for the frames with timestamp in [start, end]
+			Each frame is copied out of the file as it is reached, frames overwritten while reading are skipped
+		"""
+		with self.lock:
+			(first, count) = (int(self.header[5]), int(self.header[6]))
+		shape = self.shape if self.shape[2] > 1 else self.shape[:2]
+		for i in range(count):
+			index = (first + i) % self.capacity
+			timestamp = float(self.timestamps[index])
+			if((start != None and timestamp < start) or (end != None and timestamp > end)):
+				continue
+			frame = np.array(self.frames[index]).reshape(shape)
+			if(self.timestamps[index] != timestamp):
+				# Replaced by a newer frame while it was copied
+				continue
+			yield (timestamp, frame)
+
+	def flush(self):
+		""" Writes changed pages to disk """
+		with self.lock:
+			self.frames.flush()
+			self.timestamps.flush()
+			self.header.flush()
+
+	def close(self):
+		self.flush()
+		del self.frames
+		del self.timestamps
+		del self.header
+
+def sweep(history, algorithm, sensitivities, start=None, end=None):
+	"""
+		Runs an algorithm with several sensitivities over the stored frames, in one pass over the file
+		Generator of (timestamp, list of activity values, one per sensitivity)
+	"""
+	algs = [algFac.get_alg(algorithm, sensitivity) for sensitivity in sensitivities]
+	prev = False
+	for (timestamp, frame) in history.read(start, end):
+		activities = list()
+		for alg in algs:
+			alg.process(frame, prev)
+			activities.append(alg.get_activity())
+		prev = frame
+		yield (timestamp, activities)
+
+def rescore(history, algorithm, sensitivity=30, start=None, end=None):
+	""" Generator of (timestamp, activity) for the stored frames, using any Factory algorithm and sensitivity """
+	for (timestamp, activities) in sweep(history, algorithm, [sensitivity], start, end):
+		yield (timestamp, activities[0])
+
+def open_history(path):
+	""" Opens an existing history file, reading its shape and capacity from the header """
+	header = np.fromfile(path, dtype=np.int64, count=HEADER_FIELDS)
+	if(len(header) != HEADER_FIELDS or header[0] != MAGIC):
+		raise ValueError(path + " is not a frame history file")
+	return FrameHistory(path, tuple(int(value) for value in header[2:5]), int(header[1]))
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Re-scores a camera's frame history, printing CSV with one activity column per sensitivity")
+	parser.add_argument("file", help="History file, <history directory>/<camera id>.frames")
+	parser.add_argument("--algorithm", default="traffic")
+	parser.add_argument("--sensitivity", type=int, nargs="+", default=[30])
+	parser.add_argument("--start", type=float, help="Only frames from this unix time")
+	parser.add_argument("--end", type=float, help="Only frames until this unix time")
+	args = parser.parse_args()
+
+	history = open_history(args.file)
+	print(",".join(["timestamp"] + [str(sensitivity) for sensitivity in args.sensitivity]))
+	for (timestamp, activities) in sweep(history, args.algorithm, args.sensitivity, args.start, args.end):
+		print(",".join([repr(timestamp)] + [str(activity) for activity in activities]))
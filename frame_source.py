@@ -0,0 +1,124 @@
+import threading
+import time
+import zlib
+import numpy as np
+from frame_fetcher import default_fetcher, decode_image
+import metrics
+
+def fingerprint(image):
+	""" (shape, crc32) of an image, computed row by row so a view of a region of interest is not copied """
+	crc = 0
+	for row in image:
+		crc = zlib.crc32(np.ascontiguousarray(row), crc)
+	return (image.shape, crc & 0xffffffff)
+
+class FrameSource:
+	"""
+		A camera url, fetched and decoded once for all the cameras using it
+		Cameras asking for a frame while it is being fetched wait for that fetch instead of starting another one,
+		and the decoded grayscale frame is shared read-only, so cameras take views of their region of interest from it
+	"""
+	def __init__(self, url, fetcher=None):
+		self.url = url
+		self.fetcher = fetcher or default_fetcher
+		# HTTP validators and fingerprint of the current frame, so unchanged frames are not transferred or decoded
+		self.etag = None
+		self.last_modified = None
+		self.fingerprint = None
+		self.image = None
+		# Incremented for every new decoded frame
+		self.generation = 0
+		self.fetched_at = None
+		self.fetches = 0
+		self.decodes = 0
+		# True while a fetch is running, attempts counts finished fetches and error is the error of the last one
+		self.pending = False
+		self.attempts = 0
+		self.error = None
+		self.condition = threading.Condition()
+
+	def frame(self, max_age, cam_id=None):
+		"""
+			Returns (generation, image) of the newest frame, fetching it if the last fetch is more than max_age seconds old
+			Raises FetchError if the fetch fails, in every camera that waited for it. cam_id labels the fetch metrics.
+		"""
+		with self.condition:
+			if(self.pending):
+				attempt = self.attempts
+				while self.attempts == attempt:
+					self.condition.wait()
+				if(self.error != None):
+					raise self.error
+				return (self.generation, self.image)
+			if(self.image is not None and time.time() - self.fetched_at < max_age):
+				return (self.generation, self.image)
+			self.pending = True
+		error = None
+		try:
+			self._fetch(cam_id)
+		except Exception as e:
+			error = e
+			raise
+		finally:
+			with self.condition:
+				self.pending = False
+				self.attempts += 1
+				self.error = error
+				self.condition.notify_all()
+				result = (self.generation, self.image)
+		return result
+
+	def _fetch(self, cam_id):
+		""" Fetches the url, and decodes it if it changed, only run by one thread at a time """
+		with metrics.camera_timer("fetch", cam_id):
+			response = self.fetcher.fetch(self.url, self.etag, self.last_modified)
+		self.fetches += 1
+		self.fetched_at = time.time()
+		if(response.not_modified()):
+			return
+		self.etag = response.etag
+		self.last_modified = response.last_modified
+		fingerprint = (len(response.body), zlib.crc32(response.body))
+		if(fingerprint == self.fingerprint and self.image is not None):
+			# Same bytes as last time, the camera has not published a new frame
+			return
+		with metrics.camera_timer("decode", cam_id):
+			# The algorithms only use grayscale, so the colour frame is never kept
+			image = decode_image(response.body, grayscale=True)
+		# Shared by every camera using the url, none of them may change it
+		image.flags.writeable = False
+		self.decodes += 1
+		self.fingerprint = fingerprint
+		self.image = image
+		self.generation += 1
+
+	def memory_usage(self):
+		""" Bytes of the decoded frame """
+		image = self.image
+		return image.nbytes if image is not None else 0
+
+class SourceRegistry:
+	""" The frame sources of a set of cameras, one per url, so cameras registered with the same url share it """
+	def __init__(self, fetcher=None):
+		self.fetcher = fetcher
+		self.sources = dict()
+		self.lock = threading.Lock()
+
+	def get(self, url):
+		""" Returns the source for url, creating it the first time """
+		with self.lock:
+			source = self.sources.get(url)
+			if(source == None):
+				source = self.sources[url] = FrameSource(url, self.fetcher)
+			return source
+
+	def stats(self):
+		""" Number of sources, upstream fetches and decodes, and bytes of decoded frames held """
+		with self.lock:
+			sources = list(self.sources.values())
+		return {
+			"sources": len(sources),
+			"fetches": sum(source.fetches for source in sources),
+			"decodes": sum(source.decodes for source in sources),
+			"bytes": sum(source.memory_usage() for source in sources),
+		}
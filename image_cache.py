@@ -0,0 +1,83 @@
+import collections
+import threading
+
+# Default budget for encoded images, shared by all cameras
+DEFAULT_BUDGET = 64 * 1024 * 1024
+
+class ImageCache:
+	"""
+		Encoded images of all cameras, in every format and quality, with one memory budget
+		Entries are keyed by (camera, generation, format, quality), the least recently used are evicted first
+	"""
+	def __init__(self, budget=DEFAULT_BUDGET):
+		""" budget is the total size in bytes of the cached images """
+		self.budget = budget
+		self.entries = collections.OrderedDict()
+		# Bytes cached per camera, for the memory accounting, and the keys of each camera, so discard does not scan every entry
+		self.owner_bytes = dict()
+		self.owner_keys = dict()
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		""" Returns the cached data for key, or None, and marks it as recently used """
+		with self.lock:
+			data = self.entries.pop(key, None)
+			if(data == None):
+				self.misses += 1
+				return None
+			self.entries[key] = data
+			self.hits += 1
+			return data
+
+	def put(self, key, data):
+		""" Caches data, key[0] is the camera it belongs to, evicts other entries until the cache is within budget """
+		if(len(data) > self.budget):
+			return
+		with self.lock:
+			self._remove(key)
+			self.entries[key] = data
+			self.size += len(data)
+			self.owner_bytes[key[0]] = self.owner_bytes.get(key[0], 0) + len(data)
+			self.owner_keys.setdefault(key[0], set()).add(key)
+			while self.size > self.budget:
+				self._remove(next(iter(self.entries)))
+				self.evictions += 1
+
+	def discard(self, owner, generation=None):
+		""" Drops the entries of a camera older than generation, or all of them, when it has a new frame """
+		with self.lock:
+			for key in [key for key in self.owner_keys.get(owner, ()) if generation == None or key[1] < generation]:
+				self._remove(key)
+
+	def usage(self, owner):
+		""" Bytes cached for a camera """
+		return self.owner_bytes.get(owner, 0)
+
+	def stats(self):
+		with self.lock:
+			return {
+				"budget": self.budget,
+				"bytes": self.size,
+				"entries": len(self.entries),
+				"hits": self.hits,
+				"misses": self.misses,
+				"evictions": self.evictions,
+			}
+
+	def _remove(self, key):
+		""" Removes an entry if present, the lock must be held """
+		data = self.entries.pop(key, None)
+		if(data != None):
+			self.size -= len(data)
+			self.owner_bytes[key[0]] -= len(data)
+			self.owner_keys[key[0]].discard(key)
+			if(not self.owner_keys[key[0]]):
+				del self.owner_bytes[key[0]]
+				del self.owner_keys[key[0]]
+
+# Used by cameras not created by a Manager
+default_cache = ImageCache()
@@ -0,0 +1,152 @@
+import bisect
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+	"trafficmon_stage_seconds": "Time spent in each stage of a camera refresh",
+	"trafficmon_camera_stage_seconds": "Time spent in each stage of a camera refresh, per camera",
+	"trafficmon_algorithm_seconds": "Time spent in each stage of a detection algorithm",
+	"trafficmon_request_seconds": "Time spent handling HTTP requests, per endpoint",
+	"trafficmon_fetch_errors_total": "Failed camera fetches, per camera",
+	"trafficmon_skipped_frames_total": "Camera refreshes skipped because the frame had not changed, per camera",
+}
+
+class Histogram:
+	""" Latency histogram with fixed buckets """
+	def __init__(self, buckets):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+class NullTimer:
+	""" Returned instead of a Timer when metrics are disabled, does nothing """
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		return False
+
+NULL_TIMER = NullTimer()
+
+class Timer:
+	""" Context manager observing the time spent inside it in one or more histograms """
+	def __init__(self, registry, keys):
+		self.registry = registry
+		self.keys = keys
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self, *exc_info):
+		elapsed = time.time() - self.start
+		for key in self.keys:
+			self.registry.observe_key(key, elapsed)
+		return False
+
+class Registry:
+	"""
+		Histograms and counters, exported in the Prometheus text format
+		Series are identified by a name and a dict of labels. Nothing is recorded unless enabled is set.
+	"""
+	def __init__(self, enabled=False, buckets=DEFAULT_BUCKETS):
+		self.enabled = enabled
+		self.buckets = buckets
+		self.histograms = dict()
+		self.counters = dict()
+		self.lock = threading.Lock()
+
+	def timer(self, *series):
+		""" Returns a context manager timing into every (name, labels) pair in series """
+		if(not self.enabled):
+			return NULL_TIMER
+		return Timer(self, [self._key(name, labels) for (name, labels) in series])
+
+	def observe(self, name, value, labels=None):
+		""" Adds a value to a histogram """
+		if(self.enabled):
+			self.observe_key(self._key(name, labels), value)
+
+	def observe_key(self, key, value):
+		with self.lock:
+			histogram = self.histograms.get(key)
+			if(histogram == None):
+				histogram = self.histograms[key] = Histogram(self.buckets)
+			histogram.observe(value)
+
+	def increment(self, name, labels=None, amount=1):
+		""" Increments a counter """
+		if(not self.enabled):
+			return
+		key = self._key(name, labels)
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + amount
+
+	def render(self, gauges=None):
+		""" Returns all series in the Prometheus text format, gauges is an optional dict of name: value to include """
+		lines = list()
+		with self.lock:
+			for name in sorted(set(name for (name, labels) in self.counters)):
+				self._header(lines, name, "counter")
+				for ((series, labels), value) in sorted(self.counters.items()):
+					if(series == name):
+						lines.append(name + self._labels(labels) + " " + str(value))
+			for name in sorted(set(name for (name, labels) in self.histograms)):
+				self._header(lines, name, "histogram")
+				for ((series, labels), histogram) in sorted(self.histograms.items()):
+					if(series != name):
+						continue
+					cumulative = 0
+					for (bound, count) in zip(self.buckets, histogram.counts):
+						cumulative += count
+						lines.append(name + "_bucket" + self._labels(labels + (("le", repr(bound)),)) + " " + str(cumulative))
+					lines.append(name + "_bucket" + self._labels(labels + (("le", "+Inf"),)) + " " + str(histogram.count))
+					lines.append(name + "_sum" + self._labels(labels) + " " + repr(histogram.sum))
+					lines.append(name + "_count" + self._labels(labels) + " " + str(histogram.count))
+		for (name, value) in sorted((gauges or dict()).items()):
+			lines.append("# TYPE " + name + " gauge")
+			lines.append(name + " " + repr(float(value)))
+		return "\n".join(lines) + "\n"
+
+	@staticmethod
+	def _key(name, labels):
+		""" Hashable key for a series """
+		return (name, tuple(sorted((labels or dict()).items())))
+
+	@staticmethod
+	def _header(lines, name, kind):
+		if(name in HELP):
+			lines.append("# HELP " + name + " " + HELP[name])
+		lines.append("# TYPE " + name + " " + kind)
+
+	@staticmethod
+	def _labels(labels):
+		""" Formats labels as {key="value",...} """
+		if(not labels):
+			return ""
+		escaped = [key + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"' for (key, value) in labels]
+		return "{" + ",".join(escaped) + "}"
+
+# Shared by the whole process, enabled by the server
+registry = Registry()
+
+def camera_timer(stage, cam_id):
+	""" Times a stage of a camera refresh, both globally and for the camera """
+	if(not registry.enabled):
+		return NULL_TIMER
+	return registry.timer(("trafficmon_stage_seconds", {"stage": stage}), ("trafficmon_camera_stage_seconds", {"stage": stage, "camera": cam_id}))
+
+def algorithm_timer(algorithm, stage):
+	""" Times a stage of a detection algorithm """
+	if(not registry.enabled):
+		return NULL_TIMER
+	return registry.timer(("trafficmon_algorithm_seconds", {"algorithm": algorithm, "stage": stage}))
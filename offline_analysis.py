@@ -0,0 +1,150 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+import cv2
+import numpy as np
+from algorithm_factory import Factory as algFac
+from bulk_import import parse_subset
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+# Capture properties moved out of cv2.cv in OpenCV 3
+if(hasattr(cv2, "CAP_PROP_FPS")):
+	(CAP_PROP_FPS, CAP_PROP_FRAME_COUNT, CAP_PROP_POS_FRAMES) = (cv2.CAP_PROP_FPS, cv2.CAP_PROP_FRAME_COUNT, cv2.CAP_PROP_POS_FRAMES)
+else:
+	(CAP_PROP_FPS, CAP_PROP_FRAME_COUNT, CAP_PROP_POS_FRAMES) = (cv2.cv.CV_CAP_PROP_FPS, cv2.cv.CV_CAP_PROP_FRAME_COUNT, cv2.cv.CV_CAP_PROP_POS_FRAMES)
+
+def list_images(directory):
+	""" The image files in a directory, in name order """
+	return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.lower().endswith(IMAGE_EXTENSIONS)]
+
+def frame_count(source):
+	""" Returns (number of frames, frames per second or None) of a directory of images or a video file """
+	if(os.path.isdir(source)):
+		return (len(list_images(source)), None)
+	capture = cv2.VideoCapture(source)
+	if(not capture.isOpened()):
+		raise IOError("Could not open " + source)
+	count = int(capture.get(CAP_PROP_FRAME_COUNT))
+	fps = capture.get(CAP_PROP_FPS)
+	capture.release()
+	return (count, fps if fps > 0 else None)
+
+def read_frames(source, start, stop, paths=None):
+	""" 
+		Generator of (index, image) for frames start up to stop of a directory of images or a video file
+		paths are the image files start up to stop of a directory, if already listed
+	"""
+	if(paths == None and os.path.isdir(source)):
+		paths = list_images(source)[start:stop]
+	if(paths != None):
+		for (index, path) in enumerate(paths, start):
+			image = cv2.imread(path)
+			if(isinstance(image, np.ndarray)):
+				yield (index, image)
+		return
+	capture = cv2.VideoCapture(source)
+	capture.set(CAP_PROP_POS_FRAMES, start)
+	for index in range(start, stop):
+		(ok, image) = capture.read()
+		if(not ok):
+			break
+		yield (index, image)
+	capture.release()
+
+def crop(frames, subset):
+	""" Generator cutting the region of interest, ((x0, x1), (y0, y1)), out of each frame """
+	for (index, image) in frames:
+		if(subset):
+			image = image[subset[1][0]:subset[1][1], subset[0][0]:subset[0][1]].copy()
+		yield (index, image)
+
+def score(frames, algorithm, sensitivity):
+	""" Generator running an algorithm over consecutive frames, yields (index, activity) """
+	alg = algFac.get_alg(algorithm, sensitivity)
+	prev = False
+	for (index, image) in frames:
+		alg.process(image, prev)
+		prev = image
+		yield (index, alg.get_activity())
+
+def analyse_chunk(job):
+	"""
+		Worker, scores frames start up to stop, returns a list of (index, activity)
+		The frames from first up to start are scored as well but not returned, so the first frame of the chunk
+		has a previous frame to compare with, and algorithms that model the scene have seen the frames before it
+		paths are the image files first up to stop of a directory, None for a video
+	"""
+	(source, paths, first, start, stop, subset, algorithm, sensitivity) = job
+	frames = crop(read_frames(source, first, stop, paths), subset)
+	return [(index, activity) for (index, activity) in score(frames, algorithm, sensitivity) if index >= start]
+
+def analyse(source, subset=None, algorithm="traffic", sensitivity=30, processes=None, chunk_size=500, overlap=None):
+	"""
+		Generator of (index, activity) for every frame of source, in order
+		The frames are split into contiguous chunks, scored in parallel by processes worker processes,
+		each chunk starting overlap frames early. Algorithms that only compare a frame with the previous one need an
+		overlap of 1, the default. Stateful algorithms (such as background, which keeps a running average of the scene)
+		give the same results as a serial run only if run as one chunk, which is done unless an overlap is given,
+		a larger overlap then warms their model up and makes the results close to those of a serial run.
+	"""
+	images = list_images(source) if os.path.isdir(source) else None
+	count = len(images) if images != None else frame_count(source)[0]
+	if(overlap == None):
+		if(algFac.algs.get(algorithm, algFac.algs["none"]).stateful):
+			chunk_size = max(count, 1)
+		overlap = 1
+	jobs = list()
+	for start in range(0, count, chunk_size):
+		(first, stop) = (max(start - overlap, 0), min(start + chunk_size, count))
+		jobs.append((source, images[first:stop] if images != None else None, first, start, stop, subset, algorithm, sensitivity))
+	pool = multiprocessing.Pool(processes)
+	try:
+		for results in pool.imap(analyse_chunk, jobs):
+			for result in results:
+				yield result
+	finally:
+		pool.terminate()
+
+def write_results(results, output, fps, start_time):
+	""" Writes (index, activity) results as CSV or JSON (by the extension of output), returns the number of frames """
+	rows = ({"frame": index, "time": start_time + index / fps, "activity": activity} for (index, activity) in results)
+	written = 0
+	with open(output, "w") as handle:
+		if(output.lower().endswith(".json")):
+			handle.write("[")
+			for row in rows:
+				handle.write((",\n" if written else "\n") + json.dumps(row))
+				written += 1
+			handle.write("\n]\n")
+		else:
+			writer = csv.writer(handle)
+			writer.writerow(["frame", "time", "activity"])
+			for row in rows:
+				writer.writerow([row["frame"], row["time"], row["activity"]])
+				written += 1
+	return written
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Runs a detection algorithm over archived footage, a directory of images or a video file")
+	parser.add_argument("source", help="Directory of images, in name order, or a video file")
+	parser.add_argument("output", help="Activity time series, .csv or .json")
+	parser.add_argument("--algorithm", default="traffic", choices=sorted(algFac.algs.keys()))
+	parser.add_argument("--sensitivity", type=int, default=30)
+	parser.add_argument("--subset", help="Region of interest, x0 x1 y0 y1")
+	parser.add_argument("--processes", type=int, default=None, help="Worker processes, defaults to the number of cores")
+	parser.add_argument("--chunk-size", type=int, default=500, help="Frames per work unit")
+	parser.add_argument("--overlap", type=int, default=None, help="Frames scored before each chunk, stateful algorithms run as one chunk unless given")
+	parser.add_argument("--fps", type=float, help="Frames per second of the footage, taken from the video if not given, otherwise 1")
+	parser.add_argument("--start-time", type=float, default=0.0, help="Unix time of the first frame")
+	args = parser.parse_args()
+
+	fps = args.fps or frame_count(args.source)[1] or 1.0
+	started = time.time()
+	frames = write_results(analyse(args.source, parse_subset(args.subset), args.algorithm, args.sensitivity, args.processes, args.chunk_size, args.overlap), args.output, fps, args.start_time)
+	elapsed = time.time() - started
+	sys.stderr.write("Processed " + str(frames) + " frames in " + ("%.1f" % elapsed) + " s, " + ("%.1f" % (frames / max(elapsed, 1e-9))) + " frames per second\n")
@@ -1,7 +1,9 @@
-import gdbm as dbm
+import sys
+import json
+from storage import open_storage
 
-db = dbm.open("default.camera", 'cs')
-key = db.firstkey()
-while(key != None):
-	print("Key: " + key + " Value: " + db[key])
-	key = db.nextkey(key)
\ No newline at end of file
+# Usage: python printDb.py [gdbm|sqlite]
+db = open_storage("default", sys.argv[1] if len(sys.argv) > 1 else "gdbm")
+for (key, record) in db.load_cameras():
+	print("Key: " + key + " Value: " + json.dumps(record))
+db.close()
@@ -0,0 +1,178 @@
+import math
+import threading
+import numpy as np
+
+EARTH_RADIUS = 6371.0
+# Distance reported for items without a location, the same "magic token" Camera.get_distance uses
+NO_LOCATION = 10000.0
+
+def haversine(lat, lon, lats, lons):
+	""" Vectorized great circle distance in kilometers, lat/lon in radians, lats/lons are arrays in radians """
+	a = np.sin((lats - lat) / 2.0)**2 + math.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2.0)**2
+	return 2.0 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+class GeoIndex:
+	"""
+		Spatial index over lat/lon points, used to find the nearest cameras
+		Coordinates are kept in contiguous NumPy arrays, and rows are bucketed in a grid of cell_size degrees.
+		Queries visit rings of grid cells around the query point, until no unvisited cell can hold a closer point.
+		Ids are expected to be unique, and items are never moved or removed.
+	"""
+	def __init__(self, cell_size=0.5, capacity=64):
+		self.cell_size = float(cell_size)
+		self.lat_cells = int(math.ceil(180.0 / self.cell_size))
+		self.lon_cells = int(math.ceil(360.0 / self.cell_size))
+		self.lats = np.zeros(capacity)
+		self.lons = np.zeros(capacity)
+		self.ids = list()
+		self.rows = dict()
+		self.cells = dict()
+		self.unlocated = list()
+		self.lock = threading.Lock()
+
+	def __len__(self):
+		return len(self.ids) + len(self.unlocated)
+
+	def add(self, item_id, lat, lon):
+		""" Adds an item, lat and lon are in degrees, or None if the item has no location """
+		with self.lock:
+			if(lat == None or lon == None):
+				self.unlocated.append(item_id)
+				return
+			lon = self._normalize(lon)
+			row = len(self.ids)
+			if(row == len(self.lats)):
+				# Double the capacity, so adding n items costs O(n) copies in total
+				self.lats = np.concatenate((self.lats, np.zeros(row)))
+				self.lons = np.concatenate((self.lons, np.zeros(row)))
+			self.lats[row] = math.radians(lat)
+			self.lons[row] = math.radians(lon)
+			self.ids.append(item_id)
+			self.rows[item_id] = row
+			self.cells.setdefault(self._cell(lat, lon), list()).append(row)
+
+	def nearest(self, lat, lon, limit=20, offset=0, exclude=None):
+		"""
+			Returns up to limit (distance, id) tuples, nearest first, skipping the first offset results
+			Items without a location are listed last, with distance NO_LOCATION
+		"""
+		wanted = offset + limit
+		results = self._search(lat, lon, count=wanted, exclude=exclude)[:wanted]
+		if(len(results) < wanted):
+			results.extend(self._unlocated(wanted - len(results), exclude))
+		return results[offset:]
+
+	def within(self, lat, lon, radius, limit=None, offset=0, exclude=None):
+		""" Returns (distance, id) tuples for all items within radius kilometers, nearest first, paginated like nearest """
+		results = self._search(lat, lon, radius=radius, exclude=exclude)
+		if(limit == None):
+			return results[offset:]
+		return results[offset:offset + limit]
+
+	def _search(self, lat, lon, count=None, radius=None, exclude=None):
+		""" Visits rings of cells until count items are found, or radius is covered, returns sorted (distance, id) tuples """
+		with self.lock:
+			if(not self.ids):
+				return list()
+			lon = self._normalize(float(lon))
+			lat = float(lat)
+			excluded = [self.rows[item] for item in (exclude or ()) if item in self.rows]
+			(start_row, start_col) = self._cell(lat, lon)
+			(lat_rad, lon_rad) = (math.radians(lat), math.radians(lon))
+			found_rows = list()
+			found_distances = list()
+			found = 0
+			ring = 0
+			while True:
+				if(2 * ring + 1 >= self.lon_cells or (2 * ring + 1)**2 > len(self.cells)):
+					# The ring covers more cells than are occupied, scanning every row is cheaper
+					rows = np.arange(len(self.ids))
+					distances = haversine(lat_rad, lon_rad, self.lats[:len(self.ids)], self.lons[:len(self.ids)])
+					return self._results(rows, distances, excluded, radius)
+				rows = list()
+				for cell in self._ring(start_row, start_col, ring):
+					rows.extend(self.cells.get(cell, ()))
+				if(rows):
+					rows = np.array(rows)
+					if(excluded):
+						rows = rows[np.in1d(rows, excluded, invert=True)]
+					found_rows.append(rows)
+					found_distances.append(haversine(lat_rad, lon_rad, self.lats[rows], self.lons[rows]))
+					found += len(rows)
+				bound = self._bound(lat, lon, start_row, start_col, ring)
+				if(radius != None and bound >= radius):
+					break
+				if(count != None and found >= count):
+					distances = np.concatenate(found_distances)
+					if(np.partition(distances, count - 1)[count - 1] <= bound):
+						break
+				if(bound == float("inf")):
+					break
+				ring += 1
+			if(not found_rows):
+				return list()
+			return self._results(np.concatenate(found_rows), np.concatenate(found_distances), excluded, radius)
+
+	def _results(self, rows, distances, excluded, radius):
+		""" Filters and sorts candidate rows, returning (distance, id) tuples """
+		keep = np.ones(len(rows), dtype=bool)
+		if(excluded):
+			keep &= np.in1d(rows, excluded, invert=True)
+		if(radius != None):
+			keep &= distances <= radius
+		(rows, distances) = (rows[keep], distances[keep])
+		order = np.argsort(distances, kind="mergesort")
+		return [(float(distances[i]), self.ids[rows[i]]) for i in order]
+
+	def _unlocated(self, limit, exclude):
+		""" Returns up to limit items without location, as (NO_LOCATION, id) tuples """
+		results = list()
+		with self.lock:
+			for item in self.unlocated:
+				if(len(results) >= limit):
+					break
+				if(not exclude or item not in exclude):
+					results.append((NO_LOCATION, item))
+		return results
+
+	def _cell(self, lat, lon):
+		""" Returns the (row, column) of the grid cell containing lat/lon """
+		row = min(max(int((lat + 90.0) / self.cell_size), 0), self.lat_cells - 1)
+		col = int((lon + 180.0) / self.cell_size) % self.lon_cells
+		return (row, col)
+
+	def _ring(self, row, col, ring):
+		""" Returns the cells at exactly ring cells distance from (row, col), wrapping around in longitude """
+		cells = list()
+		for d_row in range(-ring, ring + 1):
+			cur_row = row + d_row
+			if(cur_row < 0 or cur_row >= self.lat_cells):
+				continue
+			if(abs(d_row) == ring):
+				d_cols = range(-ring, ring + 1)
+			else:
+				d_cols = (-ring, ring)
+			for d_col in d_cols:
+				cells.append((cur_row, (col + d_col) % self.lon_cells))
+		return cells
+
+	def _bound(self, lat, lon, row, col, ring):
+		""" Returns a lower bound in kilometers on the distance from lat/lon to any cell outside the searched rings """
+		lat_low = (row - ring) * self.cell_size - 90.0
+		lat_high = (row + ring + 1) * self.cell_size - 90.0
+		north = lat_high - lat if lat_high < 90.0 else float("inf")
+		south = lat - lat_low if lat_low > -90.0 else float("inf")
+		lon_low = (col - ring) * self.cell_size - 180.0
+		lon_high = (col + ring + 1) * self.cell_size - 180.0
+		delta = math.radians(min(lon - lon_low, lon_high - lon, 90.0))
+		# Distance to the nearest meridian bounding the searched cells
+		east_west = math.degrees(math.asin(min(math.sin(delta) * math.cos(math.radians(lat)), 1.0)))
+		bound = min(north, south, east_west)
+		if(bound == float("inf")):
+			return bound
+		return math.radians(bound) * EARTH_RADIUS
+
+	@staticmethod
+	def _normalize(lon):
+		""" Wraps a longitude to [-180, 180) """
+		return ((float(lon) + 180.0) % 360.0) - 180.0
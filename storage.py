@@ -0,0 +1,198 @@
+import argparse
+import json
+import sqlite3
+import threading
+
+# Backends that can be passed to Manager and open_storage
+BACKENDS = ("gdbm", "sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cameras (
+	id TEXT PRIMARY KEY,
+	name TEXT,
+	url TEXT,
+	subset TEXT,
+	interval REAL,
+	algorithm TEXT,
+	lat REAL,
+	lon REAL,
+	zones TEXT
+);
+CREATE INDEX IF NOT EXISTS cameras_location ON cameras (lat, lon);
+CREATE TABLE IF NOT EXISTS users (
+	name TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS subscriptions (
+	user TEXT NOT NULL REFERENCES users (name),
+	camera TEXT NOT NULL,
+	position INTEGER NOT NULL,
+	PRIMARY KEY (user, camera)
+);
+CREATE INDEX IF NOT EXISTS subscriptions_camera ON subscriptions (camera, user);
+"""
+
+class GdbmStorage:
+	""" The original storage, a gdbm file of JSON camera records and one of JSON subscription lists, keyed by id """
+	def __init__(self, filename):
+		# Imported here, so the SQLite backend works where gdbm is not installed
+		import gdbm as dbm
+		# Not opened in synchronous mode, write() syncs once per batch instead
+		self.user_db = dbm.open(filename + ".user", 'c')
+		self.camera_db = dbm.open(filename + ".camera", 'c')
+
+	def load_cameras(self):
+		""" Returns a list of (cam_id, record) for every stored camera """
+		return [(key, json.loads(self.camera_db[key])) for key in self._keys(self.camera_db)]
+
+	def load_users(self):
+		""" Returns a list of (user name, list of subscribed cam_ids) for every stored user """
+		return [(key, json.loads(self.user_db[key])) for key in self._keys(self.user_db)]
+
+	def write(self, cameras, users):
+		""" Stores a batch of changes, cameras is a dict of cam_id: record and users of name: list of cam_ids """
+		for (cam_id, record) in cameras.items():
+			self.camera_db[cam_id] = json.dumps(record)
+		for (name, subscriptions) in users.items():
+			self.user_db[name] = json.dumps(subscriptions)
+		if(cameras):
+			self.camera_db.sync()
+		if(users):
+			self.user_db.sync()
+
+	def subscribers(self, cam_id):
+		""" Returns the names of the users subscribed to a camera, reads every user """
+		return sorted(name for (name, subscriptions) in self.load_users() if cam_id in subscriptions)
+
+	def cameras_in_box(self, min_lat, max_lat, min_lon, max_lon):
+		""" Returns the ids of the cameras inside a bounding box, reads every camera """
+		found = list()
+		for (cam_id, record) in self.load_cameras():
+			try:
+				(lat, lon) = (float(record["lat"]), float(record["lon"]))
+			except (ValueError, TypeError):
+				continue
+			if(min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+				found.append(cam_id)
+		return sorted(found)
+
+	def close(self):
+		self.user_db.close()
+		self.camera_db.close()
+
+	@staticmethod
+	def _keys(db):
+		keys = list()
+		key = db.firstkey()
+		while key != None:
+			keys.append(key)
+			key = db.nextkey(key)
+		return keys
+
+class SqliteStorage:
+	"""
+		SQLite storage, with tables for cameras, users and subscriptions, stored in filename.sqlite
+		The database is in WAL mode so readers do not block the flusher, and every batch is one transaction
+	"""
+	def __init__(self, filename):
+		# Shared by the flusher and request threads, serialized by lock
+		self.connection = sqlite3.connect(filename + ".sqlite", check_same_thread=False)
+		self.lock = threading.Lock()
+		with self.lock:
+			self.connection.execute("PRAGMA journal_mode=WAL")
+			# Safe with WAL, a power loss can only lose the last transactions, not corrupt the database
+			self.connection.execute("PRAGMA synchronous=NORMAL")
+			self.connection.executescript(SCHEMA)
+			# Databases made before zones were added
+			if("zones" not in [row[1] for row in self.connection.execute("PRAGMA table_info(cameras)")]):
+				self.connection.execute("ALTER TABLE cameras ADD COLUMN zones TEXT")
+
+	def load_cameras(self):
+		""" Returns a list of (cam_id, record) for every stored camera """
+		with self.lock:
+			rows = self.connection.execute("SELECT id, name, url, subset, interval, algorithm, lat, lon, zones FROM cameras").fetchall()
+		cameras = list()
+		for (cam_id, name, url, subset, interval, algorithm, lat, lon, zones) in rows:
+			record = {"name": name, "url": url, "subset": json.loads(subset), "interval": interval, "algorithm": algorithm, "lat": lat, "lon": lon, "zones": json.loads(zones or "null")}
+			cameras.append((cam_id, record))
+		return cameras
+
+	def load_users(self):
+		""" Returns a list of (user name, list of subscribed cam_ids) for every stored user """
+		with self.lock:
+			names = [row[0] for row in self.connection.execute("SELECT name FROM users")]
+			rows = self.connection.execute("SELECT user, camera FROM subscriptions ORDER BY user, position").fetchall()
+		users = dict((name, list()) for name in names)
+		for (user, camera) in rows:
+			users[user].append(camera)
+		return users.items()
+
+	def write(self, cameras, users):
+		""" Stores a batch of changes in a single transaction, cameras is a dict of cam_id: record and users of name: list of cam_ids """
+		camera_rows = list()
+		for (cam_id, record) in cameras.items():
+			camera_rows.append((cam_id, record["name"], record["url"], json.dumps(record["subset"]), record["interval"], record["algorithm"], self._coordinate(record["lat"]), self._coordinate(record["lon"]), json.dumps(record.get("zones"))))
+		subscription_rows = list()
+		for (name, subscriptions) in users.items():
+			subscription_rows.extend((name, cam_id, position) for (position, cam_id) in enumerate(subscriptions))
+		with self.lock:
+			# Commits on success, rolls back the whole batch on an error
+			with self.connection:
+				self.connection.executemany("INSERT OR REPLACE INTO cameras (id, name, url, subset, interval, algorithm, lat, lon, zones) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", camera_rows)
+				self.connection.executemany("INSERT OR IGNORE INTO users VALUES (?)", [(name,) for name in users])
+				self.connection.executemany("DELETE FROM subscriptions WHERE user = ?", [(name,) for name in users])
+				self.connection.executemany("INSERT INTO subscriptions VALUES (?, ?, ?)", subscription_rows)
+
+	def subscribers(self, cam_id):
+		""" Returns the names of the users subscribed to a camera """
+		with self.lock:
+			rows = self.connection.execute("SELECT user FROM subscriptions WHERE camera = ? ORDER BY user", (cam_id,)).fetchall()
+		return [row[0] for row in rows]
+
+	def cameras_in_box(self, min_lat, max_lat, min_lon, max_lon):
+		""" Returns the ids of the cameras inside a bounding box, using the location index """
+		with self.lock:
+			rows = self.connection.execute("SELECT id FROM cameras WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ? ORDER BY id", (min_lat, max_lat, min_lon, max_lon)).fetchall()
+		return [row[0] for row in rows]
+
+	def close(self):
+		with self.lock:
+			self.connection.close()
+
+	@staticmethod
+	def _coordinate(value):
+		""" Stores malformed coordinates as NULL, so they are never inside a bounding box """
+		try:
+			return float(value)
+		except (ValueError, TypeError):
+			return None
+
+def open_storage(filename, backend="gdbm"):
+	""" Opens the storage for filename, backend is one of BACKENDS """
+	if(backend == "gdbm"):
+		return GdbmStorage(filename)
+	if(backend == "sqlite"):
+		return SqliteStorage(filename)
+	raise ValueError("Unknown storage backend: " + str(backend))
+
+def migrate(filename):
+	""" Copies all cameras and users from the gdbm files of filename to its SQLite database, in one transaction """
+	source = GdbmStorage(filename)
+	try:
+		cameras = dict(source.load_cameras())
+		users = dict(source.load_users())
+	finally:
+		source.close()
+	target = SqliteStorage(filename)
+	try:
+		target.write(cameras, users)
+	finally:
+		target.close()
+	return (len(cameras), len(users))
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="TrafficMonitor storage tools")
+	parser.add_argument("command", choices=["migrate"], help="migrate copies the gdbm files to SQLite")
+	parser.add_argument("filename", nargs="?", default="default", help="Database name, as passed to Manager")
+	args = parser.parse_args()
+	(cameras, users) = migrate(args.filename)
+	print("Migrated " + str(cameras) + " cameras and " + str(users) + " users to " + args.filename + ".sqlite")
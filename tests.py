@@ -1,10 +1,862 @@
 import unittest
+import time
+import threading
+import weakref
+import BaseHTTPServer
+import os
+import shutil
+import tempfile
+import json
+import cv2
+import numpy as np
 import algorithm_factory as af
+import benchmark
+from camera_scheduler import Scheduler, AdaptiveInterval
+import frame_fetcher
+import trafficmon_service as tf
+import random
+from spatial_index import GeoIndex, NO_LOCATION
+from activity_store import ActivitySeries
+import metrics
+import storage
+import bulk_import
+import frame_history
+from image_cache import ImageCache
+import offline_analysis
+import camera_health
+import frame_source
+import zones
+from worker_pool import AlgorithmPool
+import traffic_server
 
 class testAlgFactory(unittest.TestCase):
 	def test_traffic(self):
-		trafficalg = af.factory("traffic")
+		trafficalg = af.Factory.get_alg("traffic")
 		print(trafficalg.description)
 
+	def test_by_cost(self):
+		costs = [alg.cost for (key, alg) in af.Factory.by_cost()]
+		self.assertEqual(costs, sorted(costs))
+		self.assertEqual(af.Factory.by_cost()[0][0], "none")
+
+	def test_background(self):
+		frames = benchmark.synthetic_frames(320, 240, 10)
+		alg = af.Factory.get_alg("background", sensitivity=30)
+		alg.process(frames[0])
+		self.assertEqual(alg.get_activity(), 0)
+		for frame in frames[1:]:
+			alg.process(frame)
+		# 8 cars move over a still background, their positions in the first frame show up until the background adapts
+		self.assertTrue(0 < alg.get_activity() <= 16)
+
+	def test_traffic_does_not_keep_frames(self):
+		(first, second) = benchmark.synthetic_frames(160, 120, 2)
+		alg = af.Factory.get_alg("traffic")
+		alg.process(first)
+		alg.process(second, first)
+		self.assertTrue(alg._find_slot(first) is not None)
+		frame = weakref.ref(first)
+		del first
+		self.assertEqual(frame(), None)
+		# Two equalized frames and the difference, none of the source frames
+		self.assertEqual(alg.memory_usage(), 3 * 160 * 120)
+
+	def test_traffic_matches_stateless(self):
+		frames = benchmark.synthetic_frames(160, 120, 6)
+		engine = cv2.BRISK(30)
+		alg = af.Factory.get_alg("traffic", sensitivity=30)
+		alg.process(frames[0])
+		# In order, so each previous frame comes from the slots, then out of order, so both are preprocessed again
+		pairs = [(frames[i], frames[i - 1]) for i in range(1, len(frames))] + [(frames[1], frames[4]), (frames[2], frames[1])]
+		for (cur_image, prev_image) in pairs:
+			image = alg.process(cur_image, prev_image)
+			(keypoints, diff_image, expected) = benchmark.stateless_process(engine, cur_image, prev_image)
+			self.assertEqual([(k.pt, k.size) for k in alg.keypoints], [(k.pt, k.size) for k in keypoints])
+			self.assertTrue(np.array_equal(alg.diff_image, diff_image))
+			# drawKeypoints picks a random colour per keypoint, so the drawn images only match in shape
+			self.assertEqual(image.shape, expected.shape)
+
+class FakeCamera:
+	def __init__(self, interval):
+		self.last_updated = 0.0
+		self.update_interval = interval
+		self.fetched = False
+
+class FakeManager:
+	""" Stands in for Manager, records the order cameras are refreshed in """
+	def __init__(self, intervals):
+		self.cameras = dict()
+		for (cam_id, interval) in intervals.items():
+			self.cameras[cam_id] = FakeCamera(interval)
+		self.refreshed = list()
+
+	def next_update(self, cam_id):
+		camera = self.cameras[cam_id]
+		return camera.last_updated + camera.update_interval
+
+	def refresh_camera(self, cam_id):
+		self.refreshed.append(cam_id)
+		self.cameras[cam_id].last_updated = time.time()
+		if(cam_id == "broken"):
+			raise IOError("Camera unreachable")
+
+class testScheduler(unittest.TestCase):
+	def test_refreshes_due_cameras(self):
+		manager = FakeManager({"0": 0.0, "1": 0.0, "slow": 3600.0})
+		scheduler = Scheduler(manager, workers=2)
+		scheduler.start()
+		time.sleep(0.2)
+		scheduler.stop()
+		self.assertIn("0", manager.refreshed)
+		self.assertIn("1", manager.refreshed)
+		self.assertIn("slow", manager.refreshed)
+		# After the first refresh, the slow camera is not due for another hour
+		self.assertEqual(manager.refreshed.count("slow"), 1)
+		self.assertTrue(scheduler.stats()["scheduled"] >= 1)
+
+	def test_failing_camera_is_rescheduled(self):
+		manager = FakeManager({"broken": 0.05})
+		scheduler = Scheduler(manager, workers=1)
+		scheduler.start()
+		time.sleep(0.3)
+		scheduler.stop()
+		self.assertTrue(manager.refreshed.count("broken") > 1)
+		self.assertEqual(scheduler.stats()["failed"], scheduler.stats()["completed"])
+
+	def test_warm_up(self):
+		manager = FakeManager(dict((str(i), 3600.0) for i in range(20)))
+		scheduler = Scheduler(manager, workers=1)
+		scheduler.start(warmup_workers=4)
+		time.sleep(0.2)
+		self.assertEqual(scheduler.stats()["warming_up"], 0)
+		scheduler.stop()
+		# Fetched once each by the warm up threads, then not due for an hour
+		self.assertEqual(sorted(manager.refreshed), sorted(manager.cameras.keys()))
+		self.assertEqual(scheduler.stats()["scheduled"], 20)
+
+	def test_stop_during_warm_up(self):
+		manager = FakeManager(dict((str(i), 3600.0) for i in range(20)))
+		refresh = manager.refresh_camera
+		def slow_refresh(cam_id):
+			time.sleep(0.05)
+			refresh(cam_id)
+		manager.refresh_camera = slow_refresh
+		scheduler = Scheduler(manager, workers=1)
+		scheduler.start(warmup_workers=2)
+		time.sleep(0.02)
+		scheduler.stop()
+		# The warm up threads finish the fetch in progress and exit, nothing is refreshed after stop returns
+		refreshed = len(manager.refreshed)
+		self.assertTrue(refreshed < 20)
+		self.assertEqual([t for t in threading.enumerate() if t.name.startswith("camera-warmup-")], [])
+		time.sleep(0.1)
+		self.assertEqual(len(manager.refreshed), refreshed)
+
+class EtagHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	""" Serves the same frame forever, answering 304 when the client has it """
+	protocol_version = "HTTP/1.1"
+	def do_GET(self):
+		if(self.headers.get("If-None-Match") == '"frame-1"'):
+			self.send_response(304)
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+			return
+		self.send_response(200)
+		self.send_header("ETag", '"frame-1"')
+		self.send_header("Content-Length", "5")
+		self.end_headers()
+		self.wfile.write("frame")
+
+	def log_message(self, *args):
+		pass
+
+class testFetcher(unittest.TestCase):
+	def setUp(self):
+		self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), EtagHandler)
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+		self.url = "http://127.0.0.1:" + str(self.server.server_address[1]) + "/cam.jpg"
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	def test_conditional_get(self):
+		fetcher = frame_fetcher.Fetcher(timeout=2.0)
+		first = fetcher.fetch(self.url)
+		self.assertEqual(first.body, "frame")
+		second = fetcher.fetch(self.url, first.etag, first.last_modified)
+		self.assertTrue(second.not_modified())
+		self.assertEqual(second.body, None)
+		fetcher.close()
+
+	def test_frame_server_closes_kept_alive_connections(self):
+		server = benchmark.FrameServer(benchmark.encode_frames(benchmark.synthetic_frames(64, 48, 1)), change_rate=0).start()
+		fetcher = frame_fetcher.Fetcher(timeout=2.0)
+		fetcher.fetch(server.url(0))
+		# The connection is kept idle by the fetcher, its handler thread waits for the next request
+		self.assertEqual(len(server.connections), 1)
+		server.stop()
+		for i in range(50):
+			if(not server.connections):
+				break
+			time.sleep(0.01)
+		self.assertEqual(server.connections, set())
+		fetcher.close()
+
+class testManagerPersistence(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.filename = os.path.join(self.directory, "test")
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_changes_written_on_flush(self):
+		manager = tf.Manager(self.filename, flush_interval=3600)
+		manager.add_user("alice")
+		manager.subscribe_camera("alice", "3")
+		self.assertEqual(manager.dirty_users, set(["alice"]))
+		manager.flush()
+		self.assertEqual(manager.dirty_users, set())
+		manager.close()
+		reopened = tf.Manager(self.filename, flush_interval=3600)
+		self.assertEqual(reopened.users["alice"].get_cameras(), ["3"])
+		reopened.close()
+
+	def test_flush_writes_outside_lock(self):
+		manager = tf.Manager(self.filename, flush_interval=3600)
+		manager.add_user("alice")
+		write = manager.storage.write
+		(writing, release) = (threading.Event(), threading.Event())
+		def slow_write(cameras, users):
+			writing.set()
+			release.wait()
+			if(list(users) == ["bob"]):
+				raise IOError("Disk full")
+			write(cameras, users)
+		manager.storage.write = slow_write
+		flusher = threading.Thread(target=manager.flush)
+		flusher.start()
+		writing.wait()
+		# Not blocked by the write in progress
+		manager.add_user("bob")
+		self.assertEqual(manager.dirty_users, set(["bob"]))
+		release.set()
+		flusher.join()
+		self.assertRaises(IOError, manager.flush)
+		# A failed write is retried by the next flush
+		self.assertEqual(manager.dirty_users, set(["bob"]))
+		manager.storage.write = write
+		manager.close()
+		reopened = tf.Manager(self.filename, flush_interval=3600)
+		self.assertEqual(sorted(reopened.users), ["alice", "bob"])
+		reopened.close()
+
+	def test_sqlite_queries(self):
+		db = storage.SqliteStorage(self.filename)
+		record = {"name": "cam", "url": "http://localhost/cam.jpg", "subset": [[0, 10], [0, 20]], "interval": 30.0, "algorithm": "none", "lat": 69.6, "lon": 18.9, "zones": {"lane": [[0, 0], [10, 0], [10, 20]]}}
+		db.write({"0": record, "1": dict(record, lat=None, lon=None)}, {"alice": ["1", "0"], "bob": ["0"]})
+		db.write(dict(), {"bob": list()})
+		self.assertEqual(db.subscribers("0"), ["alice"])
+		self.assertEqual(db.cameras_in_box(69.0, 70.0, 18.0, 19.0), ["0"])
+		self.assertEqual(dict(db.load_cameras())["0"], record)
+		self.assertEqual(dict(db.load_users()), {"alice": ["1", "0"], "bob": []})
+		db.close()
+
+	def test_migrate(self):
+		manager = tf.Manager(self.filename, flush_interval=3600)
+		manager.add_user("alice")
+		manager.subscribe_camera("alice", "3")
+		manager.close()
+		self.assertEqual(storage.migrate(self.filename), (0, 1))
+		reopened = tf.Manager(self.filename, flush_interval=3600, backend="sqlite")
+		self.assertEqual(reopened.users["alice"].get_cameras(), ["3"])
+		self.assertEqual(reopened.subscribers("3"), ["alice"])
+		reopened.close()
+
+class testBulkImport(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.server = benchmark.FrameServer(benchmark.encode_frames(benchmark.synthetic_frames(64, 48, 2))).start()
+
+	def tearDown(self):
+		self.server.stop()
+		shutil.rmtree(self.directory)
+
+	def test_import(self):
+		rows = bulk_import.parse_rows("\n".join([
+			"name,url,lat,lon,subset,algorithm",
+			"first," + self.server.url(0) + ",69.6,18.9,,traffic",
+			"second," + self.server.url(1) + ",,,\"0 32 0 24\",none",
+			"bad algorithm," + self.server.url(2) + ",,,,fast",
+			"too large," + self.server.url(3) + ",,,\"0 640 0 480\",none",
+			"unreachable,http://127.0.0.1:1/cam.jpg,,,,none",
+		]), "csv")
+		manager = tf.Manager(os.path.join(self.directory, "test"), flush_interval=3600, backend="sqlite")
+		result = bulk_import.import_cameras(manager, rows, timeout=2.0)
+		self.assertEqual([(row["row"], row["cam_id"]) for row in result["accepted"]], [(1, 0), (2, 1)])
+		self.assertEqual([row["row"] for row in result["failed"]], [3, 4, 5])
+		self.assertEqual(manager.cameras["1"].subset, ((0, 32), (0, 24)))
+		# Written by the import itself, not by a later flush
+		self.assertEqual(sorted(cam_id for (cam_id, record) in manager.storage.load_cameras()), ["0", "1"])
+		manager.close()
+
+class testOfflineAnalysis(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		for (i, frame) in enumerate(benchmark.synthetic_frames(64, 48, 10)):
+			cv2.imwrite(os.path.join(self.directory, "%03d.png" % i), frame)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_chunks_match_serial(self):
+		subset = ((0, 48), (8, 40))
+		serial = list(offline_analysis.score(offline_analysis.crop(offline_analysis.read_frames(self.directory, 0, 10), subset), "traffic", 30))
+		parallel = list(offline_analysis.analyse(self.directory, subset, "traffic", 30, processes=2, chunk_size=3))
+		self.assertEqual(parallel, serial)
+		output = os.path.join(self.directory, "activity.json")
+		self.assertEqual(offline_analysis.write_results(parallel, output, 2.0, 100.0), 10)
+		with open(output) as handle:
+			self.assertEqual(json.load(handle)[3], {"frame": 3, "time": 101.5, "activity": serial[3][1]})
+
+	def test_stateful_matches_serial(self):
+		serial = list(offline_analysis.score(offline_analysis.read_frames(self.directory, 0, 10), "background", 30))
+		parallel = list(offline_analysis.analyse(self.directory, None, "background", 30, processes=2, chunk_size=3))
+		self.assertEqual(parallel, serial)
+		self.assertTrue(any(activity for (index, activity) in serial))
+
+class testFrameHistory(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, "0.frames")
+		self.frames = benchmark.synthetic_frames(64, 48, 5)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_ring(self):
+		history = frame_history.FrameHistory(self.path, (48, 64, 3), capacity=3)
+		for (i, frame) in enumerate(self.frames):
+			history.append(float(i), frame)
+		history.close()
+		reopened = frame_history.open_history(self.path)
+		stored = list(reopened.read())
+		self.assertEqual([timestamp for (timestamp, frame) in stored], [2.0, 3.0, 4.0])
+		self.assertTrue((stored[0][1] == self.frames[2]).all())
+		self.assertEqual([timestamp for (timestamp, frame) in reopened.read(3.0, 3.5)], [3.0])
+		# Another region of interest, the old frames can not be used
+		self.assertEqual(len(frame_history.FrameHistory(self.path, (10, 10, 3), capacity=3)), 0)
+
+	def test_sweep(self):
+		history = frame_history.FrameHistory(self.path, (48, 64, 3), capacity=10)
+		for (i, frame) in enumerate(self.frames):
+			history.append(float(i), frame)
+		swept = list(frame_history.sweep(history, "traffic", [10, 200]))
+		self.assertEqual(len(swept), 5)
+		single = [activity for (timestamp, activity) in frame_history.rescore(history, "traffic", 10)]
+		self.assertEqual(single, [activities[0] for (timestamp, activities) in swept])
+		self.assertTrue(sum(single) > 0)
+
+class testGeoIndex(unittest.TestCase):
+	def setUp(self):
+		random.seed(4)
+		self.index = GeoIndex(cell_size=0.5)
+		self.points = dict()
+		for i in range(500):
+			(lat, lon) = (random.uniform(68.0, 71.0), random.uniform(15.0, 22.0))
+			self.points[str(i)] = (lat, lon)
+			self.index.add(str(i), lat, lon)
+		self.index.add("nowhere", None, None)
+
+	def brute_force(self, lat, lon, exclude=()):
+		distances = list()
+		for (key, (cam_lat, cam_lon)) in self.points.items():
+			if(key not in exclude):
+				distances.append(self._distance(lat, lon, cam_lat, cam_lon))
+		return sorted(distances)
+
+	def _distance(self, lat, lon, cam_lat, cam_lon):
+		return tf.Camera(lat=cam_lat, lon=cam_lon).get_distance(lat, lon)
+
+	def test_nearest_matches_brute_force(self):
+		exclude = set(["1", "2"])
+		expected = self.brute_force(69.65, 18.95, exclude)
+		result = self.index.nearest(69.65, 18.95, limit=10, offset=5, exclude=exclude)
+		self.assertEqual(len(result), 10)
+		for ((distance, key), other) in zip(result, expected[5:15]):
+			self.assertAlmostEqual(distance, other, places=6)
+			self.assertNotIn(key, exclude)
+
+	def test_unlocated_listed_last(self):
+		result = self.index.nearest(69.65, 18.95, limit=10, offset=495)
+		self.assertEqual(result[-1], (NO_LOCATION, "nowhere"))
+		self.assertEqual(len(result), 6)
+
+	def test_within_radius(self):
+		result = self.index.within(69.65, 18.95, 25.0)
+		expected = [d for d in self.brute_force(69.65, 18.95) if d <= 25.0]
+		self.assertEqual(len(result), len(expected))
+		self.assertTrue(all(distance <= 25.0 for (distance, key) in result))
+
+class testActivitySeries(unittest.TestCase):
+	def test_ring_and_rollups(self):
+		series = ActivitySeries(capacity=10, window_size=3)
+		values = [(1000 + i * 20, i % 7) for i in range(50)]
+		for (timestamp, value) in values:
+			series.add_point(timestamp, value)
+		raw = series.query(0, 10**10)
+		# Only the last 10 points are kept
+		self.assertEqual([point["time"] for point in raw], [timestamp for (timestamp, value) in values[-10:]])
+		self.assertAlmostEqual(raw[-1]["average"], sum(value for (timestamp, value) in values[-3:]) / 3.0)
+		self.assertAlmostEqual(series.moving_average(), raw[-1]["average"])
+		# The rollups still cover every point
+		minutes = series.query(0, 10**10, "minute")
+		self.assertEqual(sum(bucket["count"] for bucket in minutes), 50)
+		self.assertEqual(max(bucket["max"] for bucket in minutes), 6)
+		hours = series.query(1000, 1000, "hour")
+		self.assertEqual(len(hours), 1)
+		self.assertEqual(hours[0]["count"], 50)
+
+class AdaptiveCamera:
+	def __init__(self):
+		self.current_interval = 30.0
+		self.cadence = None
+		self.last_change = None
+		self.activity_average = None
+		self.activity = "0"
+
+class testAdaptiveInterval(unittest.TestCase):
+	def setUp(self):
+		self.adaptive = AdaptiveInterval(min_interval=5.0, max_interval=600.0)
+		self.camera = AdaptiveCamera()
+
+	def refresh(self, changed, now):
+		self.camera.current_interval = self.adaptive.next_interval(self.camera, changed, now)
+		return self.camera.current_interval
+
+	def test_unchanged_backs_off_to_max(self):
+		for i in range(30):
+			interval = self.refresh(False, i)
+		self.assertEqual(interval, 600.0)
+
+	def test_follows_publish_cadence(self):
+		for i in range(20):
+			interval = self.refresh(True, i * 120.0)
+		self.assertAlmostEqual(self.camera.cadence, 120.0)
+		self.assertAlmostEqual(interval, 60.0)
+
+	def test_rising_activity_tightens(self):
+		for i in range(10):
+			self.refresh(True, i * 120.0)
+		self.camera.activity = "50"
+		self.camera.activity_average = 5.0
+		self.assertAlmostEqual(self.refresh(True, 1200.0), 30.0)
+		self.assertAlmostEqual(self.refresh(True, 1205.0), 15.0)
+
+class testMetrics(unittest.TestCase):
+	def test_disabled_records_nothing(self):
+		registry = metrics.Registry()
+		with registry.timer(("latency", {"stage": "fetch"})):
+			pass
+		registry.increment("errors_total")
+		self.assertEqual(registry.render(), "\n")
+
+	def test_prometheus_text(self):
+		registry = metrics.Registry(enabled=True, buckets=(0.1, 1.0))
+		registry.observe("latency", 0.05, {"stage": "fetch"})
+		registry.observe("latency", 0.5, {"stage": "fetch"})
+		registry.increment("errors_total", {"camera": '3"'})
+		lines = registry.render({"queue_depth": 2}).splitlines()
+		self.assertIn('errors_total{camera="3\\""} 1', lines)
+		self.assertIn('latency_bucket{stage="fetch",le="0.1"} 1', lines)
+		self.assertIn('latency_bucket{stage="fetch",le="1.0"} 2', lines)
+		self.assertIn('latency_bucket{stage="fetch",le="+Inf"} 2', lines)
+		self.assertIn('latency_count{stage="fetch"} 2', lines)
+		self.assertIn("queue_depth 2.0", lines)
+
+class testImageCache(unittest.TestCase):
+	def test_lru_within_budget(self):
+		cache = ImageCache(budget=10)
+		cache.put(("a", 1, "jpeg", None), "1234")
+		cache.put(("b", 1, "jpeg", None), "1234")
+		cache.get(("a", 1, "jpeg", None))
+		cache.put(("c", 1, "jpeg", None), "1234")
+		# b was used least recently
+		self.assertEqual(cache.get(("b", 1, "jpeg", None)), None)
+		self.assertEqual(cache.get(("a", 1, "jpeg", None)), "1234")
+		self.assertEqual((cache.stats()["bytes"], cache.stats()["evictions"]), (8, 1))
+		cache.put(("a", 2, "jpeg", None), "12")
+		cache.discard("a", 2)
+		self.assertEqual((cache.get(("a", 1, "jpeg", None)), cache.get(("a", 2, "jpeg", None))), (None, "12"))
+		cache.discard("a")
+		self.assertEqual((cache.usage("a"), cache.usage("c")), (0, 4))
+
+	def test_camera_keeps_only_compact_state(self):
+		server = benchmark.FrameServer(benchmark.encode_frames(benchmark.synthetic_frames(64, 48, 2))).start()
+		try:
+			camera = tf.Camera(name="cam", url=server.url(0))
+			camera.set_subset((0, 32), (0, 24))
+			camera.image_cache = ImageCache()
+			camera.update()
+		finally:
+			server.stop()
+		self.assertEqual((camera.image.shape, camera.image.dtype), ((24, 32), np.uint8))
+		# Nothing is encoded until requested
+		array = camera.snapshot.image.array
+		self.assertEqual((camera.memory_usage()["processed"], camera.memory_usage()["encoded"]), (24 * 32, 0))
+		jpeg = camera.get_encoded("jpeg", 80)[2]
+		# The first encode keeps a PNG in place of the array
+		self.assertEqual(camera.snapshot.image.array, None)
+		png = camera.get_encoded("png")[2]
+		self.assertTrue(np.array_equal(frame_fetcher.decode_image(png, grayscale=True), array))
+		self.assertEqual((camera.memory_usage()["processed"], camera.memory_usage()["encoded"]), (len(png), len(jpeg)))
+		self.assertEqual(camera.get_encoded("jpeg", 80)[2], jpeg)
+		self.assertEqual(camera.image_cache.stats()["hits"], 1)
+		# Other formats are made from the PNG
+		webp = camera.get_encoded("webp", 100)[2]
+		self.assertEqual(frame_fetcher.decode_image(webp).shape[:2], (24, 32))
+
+class testCameraHealth(unittest.TestCase):
+	def test_backoff_and_circuit(self):
+		health = camera_health.CameraHealth(failure_threshold=3, base_backoff=5.0, max_backoff=12.0)
+		health.record_failure("timed out", now=100.0)
+		self.assertEqual((health.state, health.next_attempt()), (camera_health.FAILING, 105.0))
+		self.assertFalse(health.allow(now=104.0))
+		self.assertTrue(health.allow(now=105.0))
+		health.record_failure("timed out", now=105.0)
+		health.record_failure("timed out", now=115.0)
+		# Third failure in a row opens the circuit, and the backoff is capped
+		self.assertEqual((health.state, health.next_attempt()), (camera_health.OPEN, 127.0))
+		self.assertFalse(health.allow(now=126.0))
+		self.assertTrue(health.allow(now=127.0))
+		self.assertEqual(health.state, camera_health.HALF_OPEN)
+		# A single probe at a time
+		self.assertFalse(health.allow(now=127.5))
+		health.record_failure("refused", now=127.0)
+		self.assertEqual((health.state, health.stats()["last_error"]), (camera_health.OPEN, "refused"))
+		self.assertTrue(health.allow(now=139.0))
+		health.record_success(now=139.0)
+		self.assertEqual((health.state, health.failures, health.next_attempt()), (camera_health.HEALTHY, 0, 0.0))
+
+	def test_unreachable_camera_is_not_fetched(self):
+		camera = tf.Camera(name="cam", url="http://127.0.0.1:1/")
+		camera.health = camera_health.CameraHealth(failure_threshold=1, base_backoff=60.0)
+		self.assertRaises(frame_fetcher.FetchError, camera.update)
+		self.assertEqual(camera.health.state, camera_health.OPEN)
+		self.assertFalse(camera.update())
+		self.assertEqual((camera.fetched_frames, camera.skipped_frames), (0, 1))
+
+	def test_algorithm_error_is_a_failure(self):
+		class BrokenAlg:
+			def process(self, image, prev_image):
+				raise ValueError("broken")
+		class StillSource:
+			def frame(self, max_age, cam_id=None):
+				return (1, np.zeros((32, 48), dtype=np.uint8))
+		camera = tf.Camera(name="cam", url="http://127.0.0.1:1/")
+		camera.set_source(StillSource())
+		camera.alg = BrokenAlg()
+		self.assertRaises(ValueError, camera.update)
+		self.assertEqual((camera.health.state, camera.health.stats()["last_error"]), (camera_health.FAILING, "broken"))
+
+class BlockingFetcher:
+	""" Serves one JPEG, holding every fetch until released """
+	def __init__(self, body):
+		self.body = body
+		self.calls = 0
+		self.entered = threading.Event()
+		self.release = threading.Event()
+
+	def fetch(self, url, etag=None, last_modified=None):
+		self.calls += 1
+		self.entered.set()
+		self.release.wait()
+		return frame_fetcher.Response(200, self.body)
+
+class testFrameSource(unittest.TestCase):
+	def test_concurrent_requests_coalesced(self):
+		fetcher = BlockingFetcher(benchmark.encode_frames(benchmark.synthetic_frames(64, 48, 1))[0])
+		source = frame_source.FrameSource("http://localhost/cam.jpg", fetcher)
+		results = list()
+		threads = [threading.Thread(target=lambda: results.append(source.frame(0.0))) for i in range(4)]
+		threads[0].start()
+		fetcher.entered.wait()
+		for thread in threads[1:]:
+			thread.start()
+		time.sleep(0.1)
+		fetcher.release.set()
+		for thread in threads:
+			thread.join()
+		self.assertEqual((fetcher.calls, source.decodes), (1, 1))
+		self.assertEqual(set((generation, id(image)) for (generation, image) in results), set([(1, id(source.image))]))
+		self.assertFalse(source.image.flags.writeable)
+
+	def test_cameras_share_source(self):
+		directory = tempfile.mkdtemp()
+		server = benchmark.FrameServer(benchmark.encode_frames(benchmark.synthetic_frames(64, 48, 2))).start()
+		manager = tf.Manager(os.path.join(directory, "test"), flush_interval=3600)
+		try:
+			url = server.url(0)
+			cam_ids = manager.add_cameras([{"name": "left", "url": url, "subset": ((0, 32), (0, 48))}, {"name": "right", "url": url, "subset": ((32, 64), (0, 48))}])
+			for cam_id in cam_ids:
+				manager.refresh_camera(str(cam_id))
+		finally:
+			manager.close()
+			server.stop()
+			shutil.rmtree(directory)
+		source = manager.sources.get(url)
+		self.assertEqual(manager.memory_usage()["sources"]["fetches"], 1)
+		for cam_id in cam_ids:
+			camera = manager.cameras[str(cam_id)]
+			self.assertTrue(camera.source is source)
+			self.assertEqual(camera.image.shape, (48, 32))
+			# A copy, so the camera does not keep the full frame alive
+			self.assertTrue(camera.image.base is None)
+			self.assertEqual(camera.memory_usage()["image"], 48 * 32)
+
+	def test_added_camera_uses_manager_source(self):
+		directory = tempfile.mkdtemp()
+		server = benchmark.FrameServer(benchmark.encode_frames(benchmark.synthetic_frames(64, 48, 1)), change_rate=0).start()
+		manager = tf.Manager(os.path.join(directory, "test"), flush_interval=3600)
+		try:
+			cam_id = str(manager.add_camera("cam", server.url(0)))
+			camera = manager.cameras[cam_id]
+			self.assertTrue(camera.source is manager.sources.get(server.url(0)))
+			self.assertEqual(camera.snapshot.generation, 1)
+			stats = manager.memory_usage()["sources"]
+			self.assertEqual((stats["fetches"], stats["decodes"]), (1, 1))
+		finally:
+			manager.close()
+			server.stop()
+			shutil.rmtree(directory)
+
+	def test_unchanged_frames_skipped(self):
+		frame = benchmark.synthetic_frames(64, 48, 1)[0]
+		server = benchmark.FrameServer(benchmark.encode_frames([frame]), change_rate=0).start()
+		registry = metrics.registry
+		metrics.registry = metrics.Registry(enabled=True)
+		try:
+			camera = tf.Camera(name="cam", url=server.url(0))
+			camera.subset = ((0, 32), (0, 48))
+			camera.current_interval = 0.0
+			self.assertTrue(camera.update())
+			# Answered with 304
+			self.assertFalse(camera.update())
+			# The whole body again, but the same bytes
+			camera.source.etag = None
+			self.assertFalse(camera.update())
+			self.assertEqual((camera.source.fetches, camera.source.decodes), (3, 1))
+			# A new frame that only changes outside the region of interest, the stand-in server's ETags only name the frame index
+			changed = frame.copy()
+			changed[:, 40:] = 0
+			server.frames[0] = benchmark.encode_frames([changed])[0]
+			camera.source.etag = None
+			self.assertFalse(camera.update())
+			self.assertEqual((camera.source.fetches, camera.source.decodes), (4, 2))
+			# Processed once
+			self.assertEqual((camera.snapshot.generation, camera.skipped_frames), (1, 3))
+			counters = metrics.registry.counters
+			self.assertEqual(counters[metrics.Registry._key("trafficmon_skipped_frames_total", {"camera": None, "reason": "unchanged"})], 2)
+			self.assertEqual(counters[metrics.Registry._key("trafficmon_skipped_frames_total", {"camera": None, "reason": "roi_unchanged"})], 1)
+		finally:
+			metrics.registry = registry
+			server.stop()
+
+class testZones(unittest.TestCase):
+	def test_parse(self):
+		parsed = zones.parse_zones("lane 1: 10 20 30 40\nexit: 0,0 10,0 0,10\n")
+		self.assertEqual(parsed, {"lane 1": [[10, 30], [20, 30], [20, 40], [10, 40]], "exit": [[0, 0], [10, 0], [0, 10]]})
+		self.assertEqual(zones.parse_zones('{"lane 1": [[10, 20], [30, 40]]}')["lane 1"], parsed["lane 1"])
+		self.assertEqual(zones.parse_zones(""), None)
+		self.assertRaises(ValueError, zones.parse_zones, "lane: 20 10 30 40")
+		self.assertRaises(ValueError, zones.parse_zones, {"exit": [[0, 0], [10, 0]]})
+
+	def test_count(self):
+		counter = zones.ZoneCounter({"left": [[100, 50], [110, 50], [110, 60], [100, 60]], "all": [[100, 50], [140, 50], [140, 70], [100, 70]]})
+		points = [(2.5, 3.0), (12.0, 3.0), (39.0, 19.0), (50.0, 5.0), (-1.0, 0.0)]
+		# The region of interest starts at (100, 50) in the frame
+		self.assertEqual(counter.count(points, (20, 40), (100, 50)), {"left": 1, "all": 3})
+		self.assertEqual(counter.count(np.zeros((0, 2)), (20, 40), (100, 50)), {"left": 0, "all": 0})
+
+	def test_points_of_algorithm(self):
+		frames = benchmark.synthetic_frames(320, 240, 10)
+		alg = af.Factory.get_alg("background", sensitivity=30)
+		for frame in frames:
+			alg.process(frame)
+		points = alg.get_points()
+		self.assertEqual(points.shape, (alg.get_activity(), 2))
+		counter = zones.ZoneCounter(zones.parse_zones({"left": [[0, 160], [0, 240]], "right": [[160, 320], [0, 240]]}))
+		counts = counter.count(points, (240, 320))
+		self.assertEqual(counts["left"] + counts["right"], alg.get_activity())
+
+class testCameraSnapshot(unittest.TestCase):
+	def test_concurrent_readers_see_whole_frames(self):
+		server = benchmark.FrameServer(benchmark.encode_frames(benchmark.synthetic_frames(160, 120, 5)), change_rate=200.0).start()
+		camera = tf.Camera(name="cam", url=server.url(0))
+		camera.set_algorithm(af.Factory.get_alg("background"))
+		camera.set_zones(zones.parse_zones("left: 0 80 0 120"))
+		# Fetched on every update, and a small cache so encodings are evicted while being read
+		camera.current_interval = 0.0
+		camera.image_cache = ImageCache(budget=20000)
+		done = threading.Event()
+		errors = list()
+
+		def refresh():
+			try:
+				for i in range(40):
+					camera.update()
+					time.sleep(0.005)
+			except Exception as e:
+				errors.append("update: " + str(e))
+			finally:
+				done.set()
+
+		# Snapshots with an image checked by each reader
+		checked = list()
+
+		def read():
+			seen = 0
+			count = 0
+			try:
+				while not done.is_set():
+					snapshot = camera.snapshot
+					if(snapshot.generation < seen):
+						errors.append("generation went back from " + str(seen) + " to " + str(snapshot.generation))
+					seen = snapshot.generation
+					if(snapshot.image is None):
+						continue
+					if(snapshot.updated_string != time.ctime(snapshot.frame_time) or set(snapshot.zone_activity) != set(["left"])):
+						errors.append("fields of different frames in generation " + str(seen))
+					(generation, frame_time, data) = camera.get_encoded("jpeg", 50, snapshot)
+					if((generation, frame_time) != (snapshot.generation, snapshot.frame_time) or frame_fetcher.decode_image(data).shape[:2] != snapshot.image.shape[:2]):
+						errors.append("encoded image not of generation " + str(seen))
+					count += 1
+			except Exception as e:
+				errors.append("reader: " + repr(e))
+			finally:
+				checked.append(count)
+
+		readers = [threading.Thread(target=read) for i in range(4)]
+		for thread in readers:
+			thread.start()
+		refresh()
+		for thread in readers:
+			thread.join()
+		server.stop()
+		self.assertEqual(errors, [])
+		self.assertEqual(len(checked), 4)
+		self.assertTrue(min(checked) > 0)
+		self.assertTrue(camera.snapshot.generation > 1)
+
+	def test_viewers_share_one_encode(self):
+		server = benchmark.FrameServer(benchmark.encode_frames(benchmark.synthetic_frames(64, 48, 1)), change_rate=0).start()
+		try:
+			camera = tf.Camera(name="cam", url=server.url(0))
+			camera.image_cache = ImageCache()
+			camera.update()
+		finally:
+			server.stop()
+		puts = list()
+		put = camera.image_cache.put
+		def slow_put(key, data):
+			# Long enough for every viewer to miss the cache while the first encodes
+			time.sleep(0.1)
+			puts.append(key)
+			put(key, data)
+		camera.image_cache.put = slow_put
+		results = list()
+		viewers = [threading.Thread(target=lambda: results.append(camera.get_encoded("jpeg", 50))) for i in range(8)]
+		for thread in viewers:
+			thread.start()
+		for thread in viewers:
+			thread.join()
+		self.assertEqual(len(puts), 1)
+		self.assertEqual(len(set(data for (generation, frame_time, data) in results)), 1)
+
+class testAlgorithmPool(unittest.TestCase):
+	def test_matches_in_process(self):
+		frames = [cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) for frame in benchmark.synthetic_frames(160, 120, 6)]
+		# Grayscale frames just fit, the traffic algorithm draws in colour, so its output is three times as large
+		pool = AlgorithmPool(1, frame_bytes=160 * 120)
+		try:
+			for alg_id in ("traffic", "background"):
+				local = af.Factory.get_alg(alg_id, sensitivity=20)
+				remote = af.Factory.get_alg(alg_id, sensitivity=20)
+				prev = False
+				for frame in frames:
+					(processed, activity, points) = pool.run(alg_id, remote, frame, prev)
+					expected = local.process(frame, prev)
+					self.assertTrue(np.array_equal(processed, expected))
+					self.assertEqual(activity, local.get_activity())
+					self.assertTrue(np.array_equal(points, local.get_points()))
+					prev = frame
+				# Too large for the shared buffers, processed here, starting over
+				large = cv2.resize(frames[0], (320, 240))
+				self.assertEqual(pool.run(alg_id, remote, large, prev)[0].shape[:2], (240, 320))
+		finally:
+			pool.close()
+
+class testImageServing(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.server = benchmark.FrameServer(benchmark.encode_frames(benchmark.synthetic_frames(64, 48, 1)), change_rate=0).start()
+		self.manager = tf.Manager(os.path.join(self.directory, "test"), flush_interval=3600)
+		self.cam_id = str(self.manager.add_camera("cam", self.server.url(0)))
+		self.client = traffic_server.create_app(self.manager).test_client()
+
+	def tearDown(self):
+		self.manager.close()
+		self.server.stop()
+		shutil.rmtree(self.directory)
+
+	def test_not_modified(self):
+		first = self.client.get("/img/" + self.cam_id)
+		self.assertEqual((first.status_code, first.mimetype), (200, "image/png"))
+		etag = first.headers["ETag"]
+		second = self.client.get("/img/" + self.cam_id, headers={"If-None-Match": etag})
+		self.assertEqual(second.status_code, 304)
+		self.assertEqual(second.headers["ETag"], etag)
+		# Generations start over in a new server, so its ETags must not match the old ones
+		restarted = traffic_server.create_app(self.manager).test_client()
+		self.assertEqual(restarted.get("/img/" + self.cam_id, headers={"If-None-Match": etag}).status_code, 200)
+
+	def test_format_and_quality(self):
+		low = self.client.get("/img/" + self.cam_id + "?format=jpeg&quality=10")
+		high = self.client.get("/img/" + self.cam_id + "?format=jpeg&quality=95")
+		self.assertEqual((low.mimetype, high.mimetype), ("image/jpeg", "image/jpeg"))
+		self.assertTrue(len(low.data) < len(high.data))
+		self.assertNotEqual(low.headers["ETag"], high.headers["ETag"])
+		# Out of range qualities are clamped, and PNG has no quality, so they encode and are tagged the same
+		self.assertEqual(self.client.get("/img/" + self.cam_id + "?format=jpeg&quality=500").headers["ETag"], self.client.get("/img/" + self.cam_id + "?format=jpeg&quality=100").headers["ETag"])
+		self.assertEqual(self.client.get("/img/" + self.cam_id + "?quality=50").headers["ETag"], self.client.get("/img/" + self.cam_id).headers["ETag"])
+		self.assertEqual(frame_fetcher.decode_image(low.data).shape[:2], (48, 64))
+		self.assertEqual(self.client.get("/img/" + self.cam_id + "?format=bmp").status_code, 400)
+		self.assertEqual(self.client.get("/img/nonexistent").status_code, 404)
+
+	def test_streams(self):
+		response = self.client.get("/stream/" + self.cam_id, buffered=False)
+		self.assertEqual(response.mimetype, "multipart/x-mixed-replace")
+		part = next(response.response)
+		(headers, data) = part.split("\r\n\r\n", 1)
+		self.assertTrue(headers.startswith("--frame\r\nContent-Type: image/jpeg"))
+		self.assertEqual(frame_fetcher.decode_image(data[:-2]).shape[:2], (48, 64))
+		response.close()
+		self.manager.add_user("user")
+		self.manager.subscribe_camera("user", self.cam_id)
+		with self.client.session_transaction() as session:
+			session["username"] = "user"
+		response = self.client.get("/stream/activity", buffered=False)
+		self.assertEqual(response.mimetype, "text/event-stream")
+		event = next(response.response)
+		self.assertTrue(event.startswith("data: ") and event.endswith("\n\n"))
+		self.assertEqual(json.loads(event[6:])["camera"], self.cam_id)
+		self.assertEqual(list(self.manager.subscriptions), [self.cam_id])
+		response.close()
+		# Closing the stream drops its subscription
+		self.assertEqual(self.manager.subscriptions, dict())
+
 if __name__ == "__main__":
 	unittest.main()
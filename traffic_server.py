@@ -1,22 +1,41 @@
-from flask import Flask, request, render_template, session, redirect, url_for, abort, send_file
+from flask import Flask, Response, request, render_template, session, redirect, url_for, abort, jsonify, g
 import trafficmon_service as tf
 import argparse
 import imp
 from algorithm_factory import Factory as algFac
-import io
+import time
+import datetime
+import json
+from activity_store import RESOLUTIONS
+import metrics
+from camera_scheduler import AdaptiveInterval
+from storage import BACKENDS
+import bulk_import
+import frame_history
+from camera_health import HEALTHY, FAILING, OPEN, HALF_OPEN
+from zones import parse_zones
+import csv
+import random
 
-def serve_web():
-	""" Web server implementation using Flask """
-	traffic = tf.Manager()
+# Seconds between keepalives on idle streams
+STREAM_KEEPALIVE = 15.0
+
+def create_app(traffic):
+	""" Builds the Flask application serving the cameras of a Manager """
 	serv = Flask(__name__)
+	# Part of every image ETag, generations start over when the server is restarted
+	instance = "%08x" % random.getrandbits(32)
 	
-	def before_req():
-		""" 
-			Update all cameras before every request
-			If the interval for cameras is set to 0, this adds a huge latency to requests
-		"""
-		traffic.update_all_cams()
-		return
+	def start_timer():
+		""" Records when handling of the request started, if metrics are enabled """
+		if(metrics.registry.enabled):
+			g.request_start = time.time()
+	
+	def stop_timer(response):
+		""" Records the time spent handling the request, per endpoint """
+		if(metrics.registry.enabled and 'request_start' in g):
+			metrics.registry.observe("trafficmon_request_seconds", time.time() - g.request_start, {"endpoint": request.endpoint})
+		return response
 	
 	@serv.route('/')
 	def main_menu():
@@ -52,7 +71,7 @@ def serve_web():
 			return redirect(url_for('main_menu'))
 		
 		if(request.method == 'GET'):
-			return render_template('createcam.html', algorithms=algFac.algs)
+			return render_template('createcam.html', algorithms=algFac.by_cost())
 		else:
 			alg = request.form['alg']
 			url = request.form['url']
@@ -60,25 +79,134 @@ def serve_web():
 			lat = request.form['lat']
 			lon = request.form['lon']
 			try:
-				traffic.add_camera(desc, url, algorithm=alg, cam_lat=lat, cam_lon=lon)
-			except IOError:
-				return redirect(url_for('camera_list'))
+				zones = parse_zones(request.form.get('zones', ''))
+				traffic.add_camera(desc, url, algorithm=alg, cam_lat=lat, cam_lon=lon, zones=zones)
+			except Exception as e:
+				# Unreachable, not an image, a malformed url or an image the algorithm fails on
+				return render_template('createcam.html', algorithms=algFac.by_cost(), error=str(e))
 			return redirect(url_for('camera_list'))
-	
+
+	@serv.route('/api/cameras/import', methods=['POST'])
+	def import_cameras():
+		"""
+			Adds many cameras at once, from a CSV or JSON file uploaded as "file" or sent as the request body
+			The format is taken from the format argument, or the content type, every camera is fetched once to check it.
+			Returns the accepted rows with their camera ids, and the failed rows with the reason
+		"""
+		if not check_session():
+			abort(403)
+		upload = request.files.get('file')
+		data = upload.read() if upload else request.get_data()
+		fmt = request.args.get('format')
+		if(fmt == None):
+			fmt = "json" if (request.mimetype == "application/json" or (upload and upload.filename.lower().endswith(".json"))) else "csv"
+		try:
+			rows = bulk_import.parse_rows(data, fmt)
+		except (ValueError, csv.Error) as e:
+			return jsonify(error=str(e)), 400
+		return jsonify(bulk_import.import_cameras(traffic, rows))
+
 	@serv.route('/img/<cam_id>')
 	def serve_image(cam_id):
-		""" Serves images from memory, they are already encoded as PNG """
-		if(traffic.cameras[cam_id].output_image == False):
-			return
-		(retval, img) = traffic.cameras[cam_id].output_image
-		return send_file(io.BytesIO(img), mimetype="image/png")
+		""" 
+			Serves the processed image of a camera, encoded on the first request for each frame
+			format (png, jpeg or webp) and quality can be given as arguments, 
+			ETag and Last-Modified are set, so clients polling an unchanged frame get a 304
+		"""
+		if(cam_id not in traffic.cameras):
+			abort(404)
+		fmt = request.args.get('format', 'png')
+		if(fmt not in tf.IMAGE_FORMATS):
+			abort(400)
+		# The same bytes are served for qualities that encode the same, so they share the ETag
+		quality = tf.normalize_quality(fmt, request.args.get('quality', None, type=int))
+		camera = traffic.cameras[cam_id]
+		# Read once, so the ETag and the image are of the same frame even if the camera is refreshed meanwhile
+		snapshot = camera.snapshot
+		etag = image_etag(cam_id, snapshot.generation, fmt, quality)
+		if(request.if_none_match.contains(etag)):
+			# The client has the current frame, no need to encode it
+			# Werkzeug drops Last-Modified from a 304 as an entity header, the ETag identifies the frame
+			response = Response(status=304)
+			response.set_etag(etag)
+			response.cache_control.no_cache = True
+			return response
+		encoded = camera.get_encoded(fmt, quality, snapshot)
+		if(encoded == None):
+			# Not fetched yet, or no frame could be processed
+			abort(503)
+		(generation, frame_time, data) = encoded
+		response = Response(data, mimetype=tf.IMAGE_FORMATS[fmt][1])
+		response.set_etag(image_etag(cam_id, generation, fmt, quality))
+		response.last_modified = datetime.datetime.utcfromtimestamp(frame_time)
+		# Clients may keep the image, but have to check if there is a newer one
+		response.cache_control.no_cache = True
+		return response.make_conditional(request)
 		
-			
+	@serv.route('/stream/<cam_id>')
+	def stream_camera(cam_id):
+		""" 
+			Streams the processed images of a camera as MJPEG (multipart/x-mixed-replace)
+			Each frame is encoded once and the same buffer is sent to every viewer. A viewer that can not keep up
+			skips frames, as only the latest frame is ever sent, nothing is queued per viewer
+		"""
+		if(cam_id not in traffic.cameras):
+			abort(404)
+		camera = traffic.cameras[cam_id]
+		quality = request.args.get('quality', None, type=int)
+		def frames():
+			sent = 0
+			while True:
+				encoded = camera.get_encoded("jpeg", quality)
+				if(encoded != None and encoded[0] != sent):
+					(sent, frame_time, data) = encoded
+					yield "--frame\r\nContent-Type: image/jpeg\r\nContent-Length: " + str(len(data)) + "\r\n\r\n" + data + "\r\n"
+				if(camera.wait_for_frame(sent, STREAM_KEEPALIVE) == sent):
+					# Nothing new, send the frame again, so viewers that have gone away are noticed
+					sent = 0
+		return Response(frames(), mimetype="multipart/x-mixed-replace; boundary=frame")
+	
+	@serv.route('/stream/activity')
+	def stream_activity():
+		""" Streams the activity of the user's cameras as server-sent events, one event per new frame """
+		if not check_session():
+			abort(401)
+		cams = list(traffic.users[session['username']].get_cameras())
+		def events():
+			generations = dict()
+			# Only woken by frames of the user's cameras
+			subscription = traffic.subscribe_frames(cams)
+			seen = None
+			try:
+				while True:
+					for cam_id in cams:
+						camera = traffic.cameras.get(cam_id)
+						if(camera == None):
+							continue
+						snapshot = camera.snapshot
+						if(snapshot.generation == generations.get(cam_id)):
+							continue
+						generations[cam_id] = snapshot.generation
+						event = {"camera": cam_id, "activity": snapshot.activity, "zones": snapshot.zone_activity, "generation": snapshot.generation, "updated": snapshot.updated_string}
+						yield "data: " + json.dumps(event) + "\n\n"
+					published = subscription.wait(seen, STREAM_KEEPALIVE)
+					if(published == seen):
+						yield ": keepalive\n\n"
+					seen = published
+			finally:
+				traffic.unsubscribe_frames(subscription)
+		response = Response(events(), mimetype="text/event-stream")
+		response.cache_control.no_cache = True
+		return response
+	
+	def image_etag(cam_id, generation, fmt, quality):
+		""" The ETag of an encoded image, unique per server instance, camera, frame, format and quality """
+		return "-".join((instance, cam_id, str(generation), fmt, str(quality)))
 	
 	@serv.route('/subscribe')
 	def subscribe_cam():
 		""" 
-			Either list the cameras that can be subscribed to (in order of distance)
+			Either list the cameras that can be subscribed to (in order of distance, a page at a time)
 			or return to the camera list if there is data in the request
 		"""
 		if not check_session():
@@ -87,24 +215,19 @@ def serve_web():
 		if(cam != ''):
 			traffic.subscribe_camera(session['username'], cam)
 			return redirect(url_for('camera_list'))
-		newlist = dict()
-		for element in traffic.cameras:
-			newlist[element] = traffic.cameras[element]
-			
 		lat = request.args.get('lat', '')
 		lon = request.args.get('lon', '')
+		offset = request.args.get('offset', 0, type=int)
+		limit = request.args.get('limit', 20, type=int)
 		
-		
+		comparelist = set(traffic.users[session['username']].get_cameras())
 		sortedList = list()
-		comparelist = traffic.users[session['username']].get_cameras()
-		for (key, element) in traffic.cameras.items():
-			if(lat != '' and lon != '' and key not in comparelist):
-				sortedList.append((long(element.get_distance(lat, lon)), key, element))
-			elif(key not in comparelist):
-				# Using 10000 km as the "magic token" for "no geolocation data at one end"
-				sortedList.append((long(10000.0), key, element))
-		sortedList.sort(key=lambda element: element[0])
-		return render_template('index.html', subcams = sortedList)
+		for (distance, key, element) in traffic.nearby_cameras(lat, lon, limit, offset, comparelist):
+			sortedList.append((long(distance), key, element))
+		next_offset = None
+		if(len(sortedList) == limit):
+			next_offset = offset + limit
+		return render_template('index.html', subcams = sortedList, lat = lat, lon = lon, next_offset = next_offset)
 	
 	@serv.route('/unsubscribe')
 	def unsubscribe_cam():
@@ -116,6 +239,91 @@ def serve_web():
 			traffic.unsubscribe_camera(session['username'], cam)
 		return redirect(url_for('camera_list'))
 	
+	@serv.route('/status')
+	def scheduler_status():
+		""" Returns the queue depth and lag of the camera refresh scheduler, and the health of the cameras not healthy, as JSON """
+		status = traffic.scheduler.stats()
+		status["unhealthy"] = dict((cam_id, health) for (cam_id, health) in traffic.camera_health().items() if health["state"] != HEALTHY)
+		return jsonify(status)
+	
+	@serv.route('/api/memory')
+	def memory_status():
+		""" Returns the memory used for each camera, largest first, and by the shared image cache, as JSON """
+		return jsonify(traffic.memory_usage())
+	
+	@serv.route('/api/activity/<cam_id>')
+	def activity_api(cam_id):
+		""" 
+			Returns the activity history of a camera as JSON, answered from the rollups unless resolution is raw
+			from and to are unix timestamps, defaulting to the last hour
+		"""
+		if(cam_id not in traffic.cameras):
+			abort(404)
+		resolution = request.args.get('resolution', 'minute')
+		if(resolution not in RESOLUTIONS):
+			abort(400)
+		end = request.args.get('to', time.time(), type=float)
+		start = request.args.get('from', end - 3600, type=float)
+		points = traffic.activity_store.query(cam_id, start, end, resolution)
+		return jsonify(camera=cam_id, resolution=resolution, points=points)
+
+	@serv.route('/api/zones/<cam_id>', methods=['GET', 'PUT'])
+	def zones_api(cam_id):
+		""" 
+			Returns the zones of a camera and the activity in each of them for the current frame, as JSON
+			PUT replaces the zones with the JSON object in the body, name: rectangle [[x0, x1], [y0, y1]] or polygon [[x, y], ...]
+		"""
+		camera = traffic.cameras.get(cam_id)
+		if(camera == None):
+			abort(404)
+		if(request.method == 'PUT'):
+			if not check_session():
+				abort(403)
+			try:
+				traffic.set_zones(cam_id, parse_zones(request.get_json(force=True)))
+			except (ValueError, TypeError, AttributeError) as e:
+				return jsonify(error=str(e)), 400
+		snapshot = camera.snapshot
+		return jsonify(camera=cam_id, zones=camera.zones or dict(), activity=snapshot.zone_activity, updated=snapshot.frame_time)
+
+	@serv.route('/api/rescore/<cam_id>')
+	def rescore_api(cam_id):
+		""" 
+			Re-runs an algorithm over the stored frame history of a camera, streamed as one JSON object per line
+			algorithm and sensitivity (one or more) select the algorithm, from and to limit the frames to a time range
+		"""
+		camera = traffic.cameras.get(cam_id)
+		if(camera == None or camera.history == None):
+			abort(404)
+		algorithm = request.args.get('algorithm', camera.alg.id)
+		if(algorithm not in algFac.algs):
+			abort(400)
+		sensitivities = request.args.getlist('sensitivity', type=int) or [30]
+		start = request.args.get('from', None, type=float)
+		end = request.args.get('to', None, type=float)
+		def lines():
+			for (timestamp, activities) in frame_history.sweep(camera.history, algorithm, sensitivities, start, end):
+				yield json.dumps({"time": timestamp, "activity": dict(zip(sensitivities, activities))}) + "\n"
+		return Response(lines(), mimetype="application/x-ndjson")
+	
+	@serv.route('/metrics')
+	def metrics_export():
+		""" Exports latency histograms and counters in the Prometheus text format """
+		gauges = dict()
+		for (key, value) in traffic.scheduler.stats().items():
+			gauges["trafficmon_scheduler_" + key] = value
+		states = [health["state"] for health in traffic.camera_health().values()]
+		for state in (HEALTHY, FAILING, OPEN, HALF_OPEN):
+			gauges["trafficmon_cameras_" + state.replace("-", "_")] = states.count(state)
+		memory = traffic.memory_usage()
+		for (key, value) in memory["totals"].items():
+			gauges["trafficmon_camera_memory_" + key + "_bytes"] = value
+		for (key, value) in memory["cache"].items():
+			gauges["trafficmon_image_cache_" + key] = value
+		for (key, value) in memory["sources"].items():
+			gauges["trafficmon_frame_source_" + key] = value
+		return Response(metrics.registry.render(gauges), mimetype="text/plain; version=0.0.4")
+	
 	@serv.route('/logout')
 	def logout():
 		""" Logs the user out of the session, returns to login """
@@ -131,16 +339,41 @@ def serve_web():
 	# Not a very good key...
 	serv.secret_key = 'This is a secret key'
 	
-	# Register the before_req function to be called before every request
-	serv.before_request(before_req)
+	serv.before_request(start_timer)
+	serv.after_request(stop_timer)
+	return serv
+
+def serve_web(workers=4, processes=0, enable_metrics=False, adaptive=None, warmup=16, backend="gdbm", history_frames=0, cache_bytes=tf.DEFAULT_BUDGET):
+	""" Web server implementation using Flask """
+	metrics.registry.enabled = enable_metrics
+	traffic = tf.Manager(processes=processes, adaptive=adaptive, backend=backend, history_frames=history_frames, cache_bytes=cache_bytes)
+	serv = create_app(traffic)
+	
+	# Cameras are refreshed by a pool of background workers, requests only read the latest results
+	# Cameras are also fetched for the first time in the background, so the server answers requests straight away
+	traffic.start_scheduler(workers, warmup)
 
 	# Run the server, open to the world, on port 80
 	# Remove the arguments to run the server only for localhost, and on port 5000
-	serv.run()
+	# Threaded, so streams do not block other requests
+	serv.run(threaded=True)
 	
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description="TrafficMonitor web service")
+	parser.add_argument("--workers", type=int, default=4, help="Number of threads refreshing cameras in the background")
+	parser.add_argument("--processes", type=int, default=0, help="Number of processes running detection algorithms, 0 runs them in the server process")
+	parser.add_argument("--metrics", action="store_true", help="Record stage latencies and counters, exported at /metrics")
+	parser.add_argument("--warmup", type=int, default=16, help="Number of threads fetching cameras for the first time at startup")
+	parser.add_argument("--adaptive", action="store_true", help="Adapt each camera's refresh interval to how often it publishes new frames")
+	parser.add_argument("--min-interval", type=float, default=5.0, help="Shortest refresh interval in seconds when adaptive")
+	parser.add_argument("--max-interval", type=float, default=600.0, help="Longest refresh interval in seconds when adaptive")
+	parser.add_argument("--storage", choices=BACKENDS, default="gdbm", help="Storage backend, run storage.py migrate before switching to sqlite")
+	parser.add_argument("--history", type=int, default=0, help="Keep this many frames per camera on disk, for /api/rescore")
+	parser.add_argument("--image-cache", type=int, default=64, help="Megabytes of encoded images (PNG, JPEG, WebP) cached for all cameras")
 	args = parser.parse_args()
 
-	serve_web()
+	adaptive = None
+	if(args.adaptive):
+		adaptive = AdaptiveInterval(args.min_interval, args.max_interval)
+	serve_web(args.workers, args.processes, args.metrics, adaptive, args.warmup, args.storage, args.history, args.image_cache * 1024 * 1024)
@@ -2,98 +2,151 @@ import pygame
 import xml.etree.ElementTree as et
 import cv2
 import numpy
-import urllib as ur
+import threading
+import time
+import Queue
+from collections import deque
+from algorithm_factory import Factory as algFac
+from frame_fetcher import Fetcher, decode_image
 
 WIDTH=1600
 HEIGHT=1200
 
 HESSIAN = 1400
 
+# Seconds between fetches of the cameras
+UPDATE_INTERVAL = 30
+
+def to_surface(image):
+	""" Turns a BGR or grayscale NumPy image into a pygame surface, without going through a file """
+	if(image.ndim == 2):
+		image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+	else:
+		image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+	# convert() copies the pixels into the display format, so the buffer does not have to outlive the surface
+	return pygame.image.frombuffer(image.tostring(), (image.shape[1], image.shape[0]), "RGB").convert()
+
 class DataLogger:
 	def __init__(self, length, window_size):
-		self.datapoints = list()
+		self.datapoints = deque(maxlen=length)
 		self.limit = length
-		self.average = list()
+		self.average = deque(maxlen=max(length - window_size, 0))
 		self.window_size = window_size
+		# Sum of the last window_size datapoints, kept up to date as points are added
+		self.window_sum = 0
 		self.out_x = 300
 		self.out_y = 300
 		self.max_value = 1
+		# The graph is only redrawn when points have been added since it was last drawn
+		self.surface = None
+		self.dirty = True
 
 	def add_point(self, datapoint):
+		if len(self.datapoints) >= self.window_size:
+			self.window_sum -= self.datapoints[-self.window_size]
 		self.datapoints.append(datapoint)
-		if len(self.datapoints) > self.limit:
-			self.datapoints.pop(0)
+		self.window_sum += datapoint
 		if(len(self.datapoints) > self.window_size):
-			average = sum(self.datapoints[-self.window_size:])/self.window_size
-			self.average.append(average)
-		if len(self.average) > self.limit - self.window_size:
-			self.average.pop(0)
+			self.average.append(self.window_sum/self.window_size)
 		self.max_value = max(max(self.datapoints),50)
+		self.dirty = True
 
 	def draw_image(self):
+		""" Returns the graph, cached between calls until add_point is called """
+		if(self.dirty or self.surface == None):
+			self.surface = self._draw()
+			self.dirty = False
+		return self.surface
+
+	def _draw(self):
 		retsur = pygame.Surface((self.out_x, self.out_y))
 		retsur.fill((255,255,255))
 		increment_x = self.out_x / self.limit
 		scale_y = self.out_y / self.max_value
-		prev_x = 0
-		if(len(self.datapoints) > 0):
-			prev_y = int(self.out_y - (self.datapoints[0] * scale_y))
-		cur_x = 0
-		for element in self.datapoints:
-			cur = int(self.out_y - (element * scale_y))
-			pygame.draw.line(retsur, (255,0,0), (prev_x, prev_y), (cur_x, cur))
-			prev_x = cur_x
-			prev_y = cur
-			cur_x += increment_x
-		prev_x = self.window_size*increment_x
-		if(len(self.average) > 0):
-			prev_y = int( self.out_y - (self.average[0] * scale_y))
-		cur_x = self.window_size*increment_x
-		for element in self.average:
-			cur = int( self.out_y - (element*scale_y) )
-			pygame.draw.line(retsur, (0,0,255), (prev_x, prev_y), (cur_x, cur))
-			prev_x = cur_x
-			prev_y = cur
-			cur_x += increment_x
+		points = [(i * increment_x, int(self.out_y - (element * scale_y))) for (i, element) in enumerate(self.datapoints)]
+		if(len(points) > 1):
+			pygame.draw.lines(retsur, (255,0,0), False, points)
+		points = [((self.window_size + i) * increment_x, int(self.out_y - (element * scale_y))) for (i, element) in enumerate(self.average)]
+		if(len(points) > 1):
+			pygame.draw.lines(retsur, (0,0,255), False, points)
 		return retsur
-		
+
 
 class Image():
-	def __init__(self, url, process):
+	"""
+		A webcam shown by the monitor, update() fetches and processes it on the worker thread,
+		and show() turns the result into surfaces on the render thread
+	"""
+	def __init__(self, url, process, fetcher):
 		self.url = url
+		self.fetcher = fetcher
 		self.image = False
 		self.im_proc = False
 		self.keypoints = 0
 		self.proc_image = process
-		self.prev_image = False
+		self.alg = algFac.get_alg("traffic") if process else None
 		self.cur_image = False
-		self.update()
+		self.etag = None
+		self.last_modified = None
 
 	def update(self):
-		self.get_image()
-		self.image = pygame.transform.rotozoom(self.image, 0, float((HEIGHT/2.0))/self.image.get_height())
-
-	def get_image(self):
-		(f,h) = ur.urlretrieve(self.url)
-		self.image = pygame.image.load(f)
-		self.image = self.image.convert()
-		if(self.proc_image):
-			if(isinstance(self.cur_image, numpy.ndarray)):
-				self.prev_image = self.cur_image
-			self.cur_image = cv2.equalizeHist(cv2.cvtColor(cv2.imread(f)[500:670,800:1200], cv2.COLOR_BGR2GRAY))
-			if((self.cur_image==self.prev_image).all()):
-				return
-			diffImg = self.cur_image
-			if(isinstance(self.cur_image, numpy.ndarray) and isinstance(self.prev_image,numpy.ndarray)):
-				diffImg = cv2.absdiff(self.cur_image, self.prev_image)
-			sift = cv2.BRISK(30)
-			(retval, diffImg) = cv2.threshold(diffImg, 50, 255, cv2.THRESH_TOZERO)
-			self.keypoints = sift.detect(diffImg)
-			cv2.imwrite('sift_keypoints.jpg', cv2.drawKeypoints(diffImg, self.keypoints))
-			self.im_proc = pygame.image.load('sift_keypoints.jpg')
-			print("Keypoints: " + str(len(self.keypoints)))
-			
-		
+		""" Fetches and processes a new frame, returns (scaled frame, processed frame or None, keypoints), or None if nothing changed """
+		response = self.fetcher.fetch(self.url, self.etag, self.last_modified)
+		if(response.not_modified()):
+			return None
+		(self.etag, self.last_modified) = (response.etag, response.last_modified)
+		frame = decode_image(response.body)
+		scale = float((HEIGHT/2.0))/frame.shape[0]
+		scaled = cv2.resize(frame, (int(frame.shape[1] * scale), int(frame.shape[0] * scale)))
+		if(not self.proc_image):
+			return (scaled, None, self.keypoints)
+		prev_image = self.cur_image
+		self.cur_image = frame[500:670,800:1200].copy()
+		if(isinstance(prev_image, numpy.ndarray) and prev_image.shape == self.cur_image.shape and (self.cur_image==prev_image).all()):
+			return (scaled, None, self.keypoints)
+		processed = self.alg.process(self.cur_image, prev_image)
+		print("Keypoints: " + str(self.alg.get_activity()))
+		return (scaled, processed, self.alg.get_activity())
+
+	def show(self, result):
+		""" Takes a result of update() on the render thread """
+		(scaled, processed, keypoints) = result
+		self.image = to_surface(scaled)
+		if(processed is not None):
+			self.im_proc = to_surface(processed)
+		self.keypoints = keypoints
+
+class Updater(threading.Thread):
+	""" Fetches and processes the images in the background, and hands the results to the render loop through a queue """
+	def __init__(self, images, interval=UPDATE_INTERVAL):
+		threading.Thread.__init__(self, name="monitor-update")
+		self.daemon = True
+		self.images = images
+		self.interval = interval
+		self.results = Queue.Queue()
+		self.stopping = threading.Event()
+
+	def run(self):
+		while not self.stopping.is_set():
+			started = time.time()
+			for image in self.images:
+				try:
+					result = image.update()
+				except Exception as e:
+					print("Error updating images, retrying... " + str(e))
+					continue
+				if(result != None):
+					self.results.put((image, result))
+			self.stopping.wait(max(self.interval - (time.time() - started), 0))
+
+	def take(self):
+		""" Returns the finished results, without blocking """
+		finished = list()
+		while True:
+			try:
+				finished.append(self.results.get_nowait())
+			except Queue.Empty:
+				return finished
 
 class Monitor:
 	def __init__(self):
@@ -103,14 +156,15 @@ class Monitor:
 		self.screen = pygame.display.set_mode((WIDTH,HEIGHT))
 		self.running = True
 		self.clock = pygame.time.Clock()
-		self.timer = 0
 		self.loggertimer = 0
-		self.wcs = Image("http://weather.cs.uit.no/cam/cam_east.jpg", True)
-		self.vvs = Image("http://webkamera.vegvesen.no/kamera?id=674473", False)
+		fetcher = Fetcher(timeout=10.0, connect_timeout=3.0)
+		self.wcs = Image("http://weather.cs.uit.no/cam/cam_east.jpg", True, fetcher)
+		self.vvs = Image("http://webkamera.vegvesen.no/kamera?id=674473", False, fetcher)
 		self.font = pygame.font.SysFont("Times", HEIGHT/40)
 		self.logger = DataLogger(300, 5)
-		
-	
+		self.updater = Updater([self.wcs, self.vvs])
+
+
 	def _load_config(self):
 		pass
 
@@ -120,37 +174,30 @@ class Monitor:
 				exit()
 
 	def run(self):
+		self.updater.start()
 		while self.running:
 			self.screen.fill(pygame.Color("black"))
 			# CONFIG
 			self.clock.tick(10)
-			self.timer += 1
 			self.loggertimer += 1
-			# CONFIG
-			if self.timer == 300:
-				self.update_images()
-				self.timer = 0
+			for (image, result) in self.updater.take():
+				image.show(result)
 			self.handle_events()
-			self.screen.blit(self.wcs.image, (0,0))
-			self.screen.blit(self.wcs.im_proc, (WIDTH-self.wcs.im_proc.get_width()-0, 0))
-			self.screen.blit(self.vvs.image, (0,HEIGHT/2))
-			text = self.font.render("Traffic level " + str(len(self.wcs.keypoints)), True, (255, 155,0))
+			if(self.wcs.image):
+				self.screen.blit(self.wcs.image, (0,0))
+			if(self.wcs.im_proc):
+				self.screen.blit(self.wcs.im_proc, (WIDTH-self.wcs.im_proc.get_width()-0, 0))
+			if(self.vvs.image):
+				self.screen.blit(self.vvs.image, (0,HEIGHT/2))
+			text = self.font.render("Traffic level " + str(self.wcs.keypoints), True, (255, 155,0))
 			self.screen.blit(text, (WIDTH-WIDTH/4, WIDTH/8))
-			pygame.draw.circle(self.screen, (255,0,0) , (17*(WIDTH/20),HEIGHT/3), len(self.wcs.keypoints))
+			pygame.draw.circle(self.screen, (255,0,0) , (17*(WIDTH/20),HEIGHT/3), self.wcs.keypoints)
 			if(self.loggertimer == 600):
-				self.logger.add_point(len(self.wcs.keypoints))
+				self.logger.add_point(self.wcs.keypoints)
 				self.loggertimer = 0
 			self.screen.blit(self.logger.draw_image(), (WIDTH-WIDTH/4, HEIGHT-WIDTH/4))
 			pygame.display.flip()
 
-	def update_images(self):
-		try:
-			self.wcs.update()
-			self.vvs.update()
-		except:
-			print("Error updating images, retrying...")
-			
-		
 
 if __name__ == "__main__":
 	mon = Monitor()
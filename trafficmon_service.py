@@ -2,14 +2,49 @@
 import json
 import cv2
 import numpy as np
-import urllib as ur
 import random
 import time
 from algorithm_factory import Factory as algFac
-import gdbm as dbm
+from camera_scheduler import Scheduler
+from spatial_index import GeoIndex, NO_LOCATION
+from activity_store import ActivityStore
+from worker_pool import AlgorithmPool
+from frame_history import FrameHistory
+from image_cache import ImageCache, default_cache, DEFAULT_BUDGET
+from frame_fetcher import FetchError
+from camera_health import CameraHealth
+from frame_source import FrameSource, SourceRegistry, fingerprint
+from zones import ZoneCounter
+import metrics
+from storage import open_storage
 import pickle
 import os
 import math
+import threading
+import atexit
+import collections
+
+# Formats images can be served in: (file extension, mimetype, quality parameter or None)
+IMAGE_FORMATS = {
+	"png": (".png", "image/png", None),
+	"jpeg": (".jpg", "image/jpeg", cv2.IMWRITE_JPEG_QUALITY),
+	# Not exported by every OpenCV version, 64 is its value in OpenCV
+	"webp": (".webp", "image/webp", getattr(cv2, "IMWRITE_WEBP_QUALITY", 64)),
+}
+
+def normalize_quality(fmt, quality):
+	""" The quality an image is encoded with in fmt: None if the format has no quality setting, otherwise clamped to 1-100 """
+	if(IMAGE_FORMATS[fmt][2] == None or quality == None):
+		return None
+	return min(max(int(quality), 1), 100)
+
+# What requests read of a camera's current frame: replaced as a whole by every refresh that produces a new frame,
+# and never changed, so readers see the image, activity and time of one frame without taking a lock
+# image is the processed image, a ProcessedImage, zone_activity a dict of zone name: activity
+CameraSnapshot = collections.namedtuple("CameraSnapshot", ("generation", "frame_time", "image", "activity", "zone_activity", "updated_string"))
+
+# Snapshot of a camera that has no processed frame yet
+EMPTY_SNAPSHOT = CameraSnapshot(0, None, None, "0", dict(), "Not yet fetched")
 
 class User:
 	""" Class that maintains a list of cameras a user is subscribed to """
@@ -37,6 +72,42 @@ class User:
 	def get_cameras(self):
 		return self.cameras
 
+class ProcessedImage:
+	"""
+		The processed image of a frame, kept as a read-only uint8 array until it is first encoded, then only as a lossless PNG
+		The first encode also makes the PNG and releases the array, later formats are encoded from the decoded PNG
+	"""
+	def __init__(self, array):
+		self.shape = array.shape
+		self.array = array
+		self.png = None
+		self.lock = threading.Lock()
+
+	def encode(self, extension, params):
+		""" Returns the image encoded as extension, with params as for cv2.imencode """
+		with self.lock:
+			array = self.array
+			if(self.png == None):
+				self.png = cv2.imencode(".png", array)[1].tostring()
+				# The PNG holds the same pixels, often in a fraction of the memory
+				self.array = None
+		if(extension == ".png"):
+			return self.png
+		if(array is None):
+			array = cv2.imdecode(np.frombuffer(self.png, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+		return cv2.imencode(extension, array, params)[1].tostring()
+
+	def memory_usage(self):
+		""" Bytes of the array, or of the PNG once encoded """
+		png = self.png
+		return len(png) if png != None else held_bytes(self.array)
+
+def held_bytes(image):
+	""" Bytes kept alive by an image, the whole array if it is a view """
+	if(not isinstance(image, np.ndarray)):
+		return 0
+	return image.base.nbytes if isinstance(image.base, np.ndarray) else image.nbytes
+
 class Camera:
 	""" Camera class, contains information about a camera, as well as a reference to algorithm, and images """
 	def __init__(self, name=None, url=None, interval=30.0, prev_image=False, dbm_input=None, lat=None, lon=None):
@@ -48,6 +119,7 @@ class Camera:
 			self._init_dbm(dbm_input)
 		else:
 			self.subset = False
+			self.zones = None
 			self.name = name
 			self.url = url
 			self.alg = algFac.get_alg("none")
@@ -60,18 +132,56 @@ class Camera:
 				self.longitude = None
 
 		self.update_interval = interval
-		self.image = False
-		self.output_image = False
-		self.prev_image = prev_image
-		self.last_updated = time.time()
-		self.updated_string = time.ctime()
+		# The interval actually used, differs from update_interval when the Manager adapts it
+		self.current_interval = self.update_interval
+		# Observed publish period, time of the last new frame and average activity, used to adapt the interval
+		self.cadence = None
+		self.last_change = None
+		self.activity_average = None
+		# The grayscale region of interest of the current frame, the algorithm compares the next frame with it
+		# Only the region of interest is kept, not the full frame of the camera's FrameSource
+		self.image = prev_image
+		# The published frame, see CameraSnapshot, its image is encoded on request and the encodings cached in image_cache
+		# The generation is incremented for every new frame, encoded versions are cached per generation
+		self.snapshot = EMPTY_SNAPSHOT
+		self.image_cache = default_cache
+		# Notified when a new frame is published, for streaming clients, readers of the snapshot do not need it
+		self.image_lock = threading.Lock()
+		self.frame_ready = threading.Condition(self.image_lock)
+		# Keys of the encodings in progress, requests for one of them wait for it instead of encoding it again
+		self.encoding = set()
+		self.encoded = threading.Condition(self.image_lock)
+		# Runs the algorithm in a worker process if set, see Manager(processes=...)
+		self.runner = None
+		# Set by the Manager, used to label metrics
+		self.cam_id = None
+		# Not fetched yet, so the camera is due for a refresh straight away
+		self.fetched = False
+		self.last_updated = 0.0
+		# Activity of the last processed frame, for the refresh bookkeeping, requests read it from the snapshot
 		self.activity = "0"
-		self.update()
+		# Counts activity per named zone from the points found by the algorithm
+		self.zone_counter = ZoneCounter(self.zones) if self.zones else None
+		# Fetches and decodes the url, shared with other cameras using the same url when set by a Manager, see set_source
+		self.source = None
+		# Generation of the last source frame used, and fingerprint of its region of interest, used to skip unchanged frames
+		self.source_generation = None
+		self.roi_fingerprint = None
+		self.fetched_frames = 0
+		self.skipped_frames = 0
+		# Backoff and circuit breaker for cameras that fail to answer
+		self.health = CameraHealth()
+		# If set by the Manager, new frames of the region of interest are kept in a FrameHistory at history_path
+		self.history_path = None
+		self.history_frames = 0
+		self.history = None
 		
 	def _init_dbm(self, dbm_repr):
 		""" Loads a camera from a dbm representation, used when loading from disk """
 		self.name = dbm_repr["name"]
 		self.subset = dbm_repr["subset"]
+		# Not stored by older versions
+		self.zones = dbm_repr.get("zones")
 		self.url = dbm_repr["url"]
 		self.update_interval = dbm_repr["interval"]
 		self.alg = algFac.get_alg(dbm_repr["algorithm"])
@@ -98,138 +208,548 @@ class Camera:
 		c = 2 * math.asin(math.sqrt(a))
 		return radius_of_earth * c
 
-	def get_dbm(self):
-		""" Get the json representation of this camera """
+	def get_record(self):
+		""" Get the stored fields of this camera as a dict """
 		json_repr = dict()
 		json_repr["name"] = self.name
 		json_repr["subset"] = self.subset
+		json_repr["zones"] = self.zones
 		json_repr["url"] = self.url
 		json_repr["interval"] = self.update_interval
 		json_repr["algorithm"] = self.alg.id
 		json_repr["lat"] = self.latitude
 		json_repr["lon"] = self.longitude
-		return json.dumps(json_repr)
+		return json_repr
+
+	def get_dbm(self):
+		""" Get the json representation of this camera """
+		return json.dumps(self.get_record())
 
 	def update(self):
-		""" Runs the detection algorithm and updates images, quite expensive, so should only be called at self.interval """
+		""" 
+			Runs the detection algorithm and updates images, quite expensive, so should only be called at self.interval
+			Returns False if the camera has not published a new frame since the last update,
+			or if it is failing and is not due for another attempt yet, see CameraHealth
+		"""
+		if(not self.health.allow()):
+			# Not fetched at all, so a dead camera costs nothing until its next probe
+			self._skip_frame("circuit_open")
+			return False
 		self.last_updated = time.time()
-		self.updated_string = time.ctime()
-		(f,h) = ur.urlretrieve(self.url)
-		# TODO: Remove the disk access, do it in memory
-		tempImage = cv2.imread(f)
+		try:
+			changed = self._update()
+		except Exception as e:
+			# A camera whose frames break the algorithm or the worker is backed off like one that cannot be fetched
+			self.health.record_failure(e)
+			raise
+		self.health.record_success()
+		return changed
+
+	def _update(self):
+		""" Fetches and processes a frame for update, returns False if there was no new frame """
+		if(self.source == None):
+			# Not part of a Manager, so the camera has a source of its own
+			self.set_source(FrameSource(self.url))
+		try:
+			# A frame fetched for another camera with the same url in the last half interval is used as is
+			(generation, frame) = self.source.frame(self.current_interval / 2.0, self.cam_id)
+		except FetchError:
+			# Answering with something that is not an image counts as a failure too
+			metrics.registry.increment("trafficmon_fetch_errors_total", {"camera": self.cam_id})
+			raise
+		self.fetched_frames += 1
+		self.fetched = True
+		if(generation == self.source_generation):
+			# The camera has not published a new frame, so there is no need to run the algorithm
+			self._skip_frame("unchanged")
+			return False
+		self.source_generation = generation
+		tempImage = frame
 		if(self.subset):
-			tempImage = tempImage[self.subset[1][0]:self.subset[1][1], self.subset[0][0]:self.subset[0][1]]
-		if(isinstance(tempImage, np.ndarray) and isinstance(self.image, np.ndarray) and tempImage.shape == self.image.shape):
-			# Make sure both the current image and the new image are not the same before updating
-			if(np.bitwise_xor(tempImage, self.image).any()):
-				self.prev_image = self.image
-				self.image = tempImage
-		elif(isinstance(self.image, bool)):
-			self.image = tempImage
-		elif(tempImage.shape != self.image.shape):
-			self.image = tempImage
-		self.processed_image = self.alg.process(self.image, self.prev_image)
-		self.activity = str(len(self.alg.keypoints))
-		# The output image is in memory, encoded in PNG format
-		self.output_image = cv2.imencode(".png", self.processed_image)
-			
+			# The source frame is never changed, so the region of interest is only a view while it is compared
+			tempImage = frame[self.subset[1][0]:self.subset[1][1], self.subset[0][0]:self.subset[0][1]]
+		roi_fingerprint = fingerprint(tempImage)
+		if(roi_fingerprint == self.roi_fingerprint):
+			# The frame changed, but not inside the region of interest
+			self._skip_frame("roi_unchanged")
+			return False
+		if(tempImage.base is frame and tempImage.size < frame.size):
+			# Kept by the camera and its algorithm, a view would keep the whole frame alive after the source moves on
+			tempImage = tempImage.copy()
+		if(isinstance(self.image, np.ndarray) and tempImage.shape == self.image.shape):
+			prev_image = self.image
+		else:
+			# First frame, or the region of interest changed, so there is nothing to compare with
+			prev_image = False
+		self.roi_fingerprint = roi_fingerprint
+		self.image = tempImage
+		if(self.history_path):
+			self._record_history(tempImage)
+		with metrics.camera_timer("process", self.cam_id):
+			if(self.runner):
+				(processed_image, activity, points) = self.runner.process(self.alg, tempImage, prev_image)
+			else:
+				processed_image = self.alg.process(tempImage, prev_image)
+				activity = self.alg.get_activity()
+				points = self.alg.get_points()
+		self.activity = str(activity)
+		zone_activity = dict()
+		zone_counter = self.zone_counter
+		if(zone_counter):
+			# Zones are in frame coordinates, the points in region of interest coordinates
+			origin = (self.subset[0][0], self.subset[1][0]) if self.subset else (0, 0)
+			zone_activity = zone_counter.count(points, tempImage.shape, origin)
+		# Not encoded until it is requested, so encoding scales with viewers rather than cameras
+		processed_image = processed_image.astype(np.uint8, copy=False)
+		processed_image.flags.writeable = False
+		# Published with a single assignment, readers have either the previous frame or this one
+		self.snapshot = CameraSnapshot(self.snapshot.generation + 1, self.last_updated, ProcessedImage(processed_image), self.activity, zone_activity, time.ctime(self.last_updated))
+		# Only the older frames, encodings of this one may already have been made for viewers woken below
+		self.image_cache.discard(self, self.snapshot.generation)
+		with self.image_lock:
+			self.frame_ready.notify_all()
+		return True
+
+	def _record_history(self, image):
+		""" Stores a new frame in the camera's history, recreating the history if the region of interest changed """
+		shape = image.shape if image.ndim == 3 else image.shape + (1,)
+		if(self.history == None or self.history.shape != shape or self.history.capacity != self.history_frames):
+			self.history = FrameHistory(self.history_path, shape, self.history_frames)
+		self.history.append(self.last_updated, image)
+
+	def wait_for_frame(self, generation, timeout):
+		""" Blocks until the camera has a frame newer than generation, or timeout seconds, returns the current generation """
+		with self.image_lock:
+			if(self.snapshot.generation == generation):
+				self.frame_ready.wait(timeout)
+			return self.snapshot.generation
+
+	def _skip_frame(self, reason):
+		""" Counts a refresh that did not produce a new frame """
+		self.skipped_frames += 1
+		metrics.registry.increment("trafficmon_skipped_frames_total", {"camera": self.cam_id, "reason": reason})
+
+	def get_encoded(self, fmt="png", quality=None, snapshot=None):
+		""" 
+			Returns (generation, frame_time, data) for the processed image encoded in fmt, None if there is no image yet
+			snapshot is the frame to encode, the current one if not given
+			Every format is encoded on the first request and kept until the next frame, the PNG by the snapshot's image,
+			the other formats in the image cache until evicted, so each is usually encoded once per frame.
+			Requests arriving while it is encoded wait for it.
+		"""
+		(extension, mimetype, quality_param) = IMAGE_FORMATS[fmt]
+		quality = normalize_quality(fmt, quality)
+		snapshot = snapshot or self.snapshot
+		if(snapshot.image is None):
+			return None
+		key = (self, snapshot.generation, fmt, quality)
+		with self.image_lock:
+			data = self._cached(key, snapshot.image)
+			while data == None and key in self.encoding:
+				# Viewers woken by the same frame all ask for it at once, only the first encodes it
+				self.encoded.wait()
+				data = self._cached(key, snapshot.image)
+			if(data != None):
+				return (snapshot.generation, snapshot.frame_time, data)
+			self.encoding.add(key)
+		try:
+			params = [quality_param, quality] if quality != None else []
+			with metrics.camera_timer("encode", self.cam_id):
+				data = snapshot.image.encode(extension, params)
+			if(fmt != "png"):
+				self.image_cache.put(key, data)
+		finally:
+			with self.image_lock:
+				self.encoding.discard(key)
+				self.encoded.notify_all()
+		return (snapshot.generation, snapshot.frame_time, data)
+
+	def _cached(self, key, image):
+		""" The encoding for key if it has been made, the PNG is kept by the image itself and the other formats in the image cache """
+		if(key[2] == "png"):
+			return image.png
+		return self.image_cache.get(key)
+
+	def memory_usage(self):
+		""" Bytes held for this camera: frame, processed image (array or PNG), cached encodings and algorithm state """
+		processed = self.snapshot.image
+		usage = {
+			"image": held_bytes(self.image),
+			"processed": processed.memory_usage() if processed != None else 0,
+			"encoded": self.image_cache.usage(self),
+			"algorithm": self.alg.memory_usage(),
+			"zones": self.zone_counter.memory_usage() if self.zone_counter else 0,
+		}
+		usage["total"] = sum(usage.values())
+		return usage
 
 	def set_subset(self, x, y):
 		""" Selects a subset of the image to use for processing, takes in a tuple of x and y values """
 		self.subset = ((x[0],x[1]), (y[0],y[1]))
+		# The next frame has to be processed, even if the camera has not published a new one
+		self.source_generation = None
+		self.roi_fingerprint = None
+
+	def set_source(self, source):
+		""" Sets the FrameSource the camera takes its frames from, generations of different sources are not comparable """
+		self.source = source
+		self.source_generation = None
+		self.roi_fingerprint = None
+
+	def set_zones(self, zones):
+		""" Sets the named zones activity is counted in, a dict of name: polygon in frame coordinates (see zones.parse_zones), or None """
+		self.zones = zones or None
+		self.zone_counter = ZoneCounter(zones) if zones else None
+		self.source_generation = None
+		self.roi_fingerprint = None
 
 	def set_algorithm(self, algorithm):
 		""" Takes an algorithm, sets the cameras algorithm to this algorithm """
 		self.alg = algorithm
+		self.source_generation = None
+		self.roi_fingerprint = None
+
+class FrameSubscription:
+	""" Counts the new frames of the cameras a streaming client follows, see Manager.subscribe_frames """
+	def __init__(self):
+		self.published = 0
+		self.condition = threading.Condition()
+
+	def notify(self):
+		with self.condition:
+			self.published += 1
+			self.condition.notify_all()
+
+	def wait(self, seen, timeout):
+		""" Blocks until a frame is published after seen (a published value), or timeout seconds, returns published """
+		with self.condition:
+			if(self.published == seen):
+				self.condition.wait(timeout)
+			return self.published
 
 class Manager():
 	""" The manager class ties the user, cameras and algorithms together, contains a set of each """
-	def __init__(self, filename="default"):
-		""" Reads users and cameras from disk, and initializes dicts """
+	def __init__(self, filename="default", flush_interval=1.0, processes=0, adaptive=None, backend="gdbm", history_frames=0, history_dir=None, cache_bytes=DEFAULT_BUDGET):
+		""" 
+			Reads users and cameras from disk, and initializes dicts
+			backend is the storage used, "gdbm" or "sqlite", see storage.py
+			Changes are written to disk in batches every flush_interval seconds
+			If processes is set, algorithms run in that many worker processes instead of in this process
+			adaptive is an AdaptiveInterval, if set refresh intervals are adapted to each camera's change rate
+			If history_frames is set, the last history_frames frames of every camera are kept in history_dir, see set_history
+			cache_bytes is the memory budget for encoded images of all cameras, in every format
+		"""
+		self.adaptive = adaptive
+		# Started first, the workers are forked and should not inherit any threads or open files
+		self.algorithm_pool = None
+		if(processes):
+			self.algorithm_pool = AlgorithmPool(processes)
 		self.users = dict()
 		self.cameras = dict()
 		self.maxCamId = 0
 		self.algorithms = algFac
 		self.filename=filename
+		self.scheduler = None
+		# Camera coordinates, for finding the cameras nearest to a user
+		self.geo_index = GeoIndex()
+		# History of the activity of every camera, for the activity API
+		self.activity_store = ActivityStore()
+		# cam_id: FrameSubscriptions of the streams following that camera, so a new frame only wakes its own streams
+		self.subscriptions = dict()
+		self.subscriptions_lock = threading.Lock()
+		
+		self.storage = open_storage(filename, backend)
+		self.history_frames = history_frames
+		self.history_dir = history_dir or filename + ".history"
+		# Encoded images of all cameras share one memory budget
+		self.image_cache = ImageCache(cache_bytes)
+		# Cameras with the same url share one FrameSource, so each url is fetched and decoded once per refresh
+		self.sources = SourceRegistry()
 		
-		self.user_db = dbm.open(filename + ".user", 'cs')
-		self.camera_db = dbm.open(filename + ".camera", 'cs')
+		# Ids of records changed since the last flush, protected by db_lock
+		self.dirty_cameras = set()
+		self.dirty_users = set()
+		self.db_lock = threading.RLock()
+		# Held for a whole flush, so a flush returns only once everything changed before it is written
+		self.flush_lock = threading.Lock()
 		
 		self._load_from_file()
 		
+		self.flush_interval = flush_interval
+		self.closing = threading.Event()
+		self.flusher = threading.Thread(target=self._flush_loop, name="manager-flush")
+		self.flusher.daemon = True
+		self.flusher.start()
+		atexit.register(self.close)
+	
+	def flush(self):
+		""" 
+			Writes all users and cameras changed since the last flush to disk
+			The changes are copied under db_lock and written outside it, so requests are not held up by the disk
+		"""
+		with self.flush_lock:
+			with self.db_lock:
+				if(not self.dirty_cameras and not self.dirty_users):
+					return
+				cameras = dict((key, self.cameras[key].get_record()) for key in self.dirty_cameras)
+				users = dict((key, list(self.users[key].get_cameras())) for key in self.dirty_users)
+				(dirty_cameras, dirty_users) = (self.dirty_cameras, self.dirty_users)
+				self.dirty_cameras = set()
+				self.dirty_users = set()
+			try:
+				self.storage.write(cameras, users)
+			except Exception:
+				# Written again by the next flush
+				with self.db_lock:
+					self.dirty_cameras |= dirty_cameras
+					self.dirty_users |= dirty_users
+				raise
+	
+	def close(self):
+		""" Stops the background flush, writes any pending changes and closes the database files """
+		if(self.closing.is_set()):
+			return
+		self.closing.set()
+		self.flusher.join()
+		self.stop_scheduler()
+		if(self.algorithm_pool):
+			self.algorithm_pool.close()
+		self.flush()
+		self.storage.close()
+		for camera in self.cameras.values():
+			if(camera.history):
+				camera.history.flush()
+	
+	def _flush_loop(self):
+		""" Background thread, flushes pending changes every flush_interval seconds """
+		while not self.closing.wait(self.flush_interval):
+			try:
+				self.flush()
+			except Exception as e:
+				print("Error writing changes to disk: " + str(e))
 	
 	def add_user(self, name):
-		""" Add a single user to the system, saves to file if the user is new """
-		if(name in self.users):
-			return False
-		else:
+		""" Add a single user to the system, marks it for saving if the user is new """
+		with self.db_lock:
+			if(name in self.users):
+				return False
 			self.users[name] = User(name)
-			self._save_to_file()
+			self.dirty_users.add(name)
 			return True
 	
-	def add_camera(self, cam_name, cam_url, subset=None, algorithm=None, cam_lat=None, cam_lon=None):
-		""" Add a camera to the system, saves to file, note that duplicates can be added """
+	def add_camera(self, cam_name, cam_url, subset=None, algorithm=None, cam_lat=None, cam_lon=None, zones=None):
+		""" 
+			Add a camera to the system, marks it for saving, note that duplicates can be added
+			zones is a dict of name: polygon activity is counted in, see zones.parse_zones
+			The camera is fetched once before it is added, so an unreachable url raises an IOError
+		"""
 		newCamera = Camera(name=cam_name, url=cam_url, lat=cam_lat, lon=cam_lon)
 		if(subset):
 			newCamera.set_subset(subset[0], subset[1])
 		if(algorithm):
 			newCamera.set_algorithm(self.algorithms.get_alg(algorithm))
+		if(zones):
+			newCamera.set_zones(zones)
+		with self.db_lock:
+			# Reserved before the first fetch, so it uses this manager's source, cache and worker, the id is skipped if it fails
+			cam_id = str(self.maxCamId)
+			self.maxCamId += 1
+		self._prepare(cam_id, newCamera)
+		newCamera.update()
 			
-		self.cameras[str(self.maxCamId)] = newCamera
-		self.maxCamId += 1
-		self._save_to_file()
-		return self.maxCamId - 1
-	
+		with self.db_lock:
+			self._attach(cam_id, newCamera)
+			self.dirty_cameras.add(cam_id)
+		if(self.scheduler):
+			self.scheduler.schedule(cam_id)
+		return int(cam_id)
+
+	def add_cameras(self, records):
+		"""
+			Adds several cameras at once, records are dicts with name, url, interval, lat, lon, subset, zones and algorithm
+			The cameras are not fetched here, and are written to storage in a single batch before they become visible,
+			so if the write fails none of them are added. Returns the new camera ids, in the order of records.
+		"""
+		newCameras = list()
+		for record in records:
+			newCamera = Camera(name=record["name"], url=record["url"], interval=record.get("interval", 30.0), lat=record.get("lat"), lon=record.get("lon"))
+			if(record.get("subset")):
+				newCamera.set_subset(record["subset"][0], record["subset"][1])
+			newCamera.set_algorithm(self.algorithms.get_alg(record.get("algorithm") or "none"))
+			if(record.get("zones")):
+				newCamera.set_zones(record["zones"])
+			newCameras.append(newCamera)
+
+		with self.db_lock:
+			cam_ids = [str(self.maxCamId + i) for i in range(len(newCameras))]
+			self.storage.write(dict((cam_id, camera.get_record()) for (cam_id, camera) in zip(cam_ids, newCameras)), dict())
+			for (cam_id, newCamera) in zip(cam_ids, newCameras):
+				self._attach(cam_id, newCamera)
+			self.maxCamId += len(newCameras)
+		if(self.scheduler):
+			for cam_id in cam_ids:
+				self.scheduler.schedule(cam_id)
+		return [int(cam_id) for cam_id in cam_ids]
+
+	def _prepare(self, cam_id, camera):
+		""" Gives a camera the id, shared frame source, image cache and algorithm worker it has in this manager """
+		camera.cam_id = cam_id
+		camera.image_cache = self.image_cache
+		if(camera.source is not self.sources.get(camera.url)):
+			camera.set_source(self.sources.get(camera.url))
+		if(self.algorithm_pool):
+			camera.runner = self.algorithm_pool.bind(cam_id)
+
+	def _attach(self, cam_id, camera):
+		""" Makes a camera part of this manager, under cam_id """
+		self._prepare(cam_id, camera)
+		self.cameras[cam_id] = camera
+		self.geo_index.add(cam_id, camera.latitude, camera.longitude)
+		if(self.history_frames):
+			self.set_history(cam_id, self.history_frames)
+
+	def camera_health(self):
+		""" Returns a dict of cam_id: health stats (see CameraHealth.stats) """
+		return dict((cam_id, camera.health.stats()) for (cam_id, camera) in self.cameras.items())
+
+	def memory_usage(self):
+		""" Returns per-camera memory usage in bytes (see Camera.memory_usage), largest first, the totals, and the shared frame sources """
+		cameras = [dict(camera.memory_usage(), camera=cam_id) for (cam_id, camera) in self.cameras.items()]
+		cameras.sort(key=lambda usage: usage["total"], reverse=True)
+		totals = dict((key, sum(usage[key] for usage in cameras)) for key in ("image", "processed", "encoded", "algorithm", "zones", "total"))
+		return {"totals": totals, "cache": self.image_cache.stats(), "sources": self.sources.stats(), "cameras": cameras}
+
+	def set_history(self, cam_id, frames):
+		""" 
+			Keeps the last frames new frames of a camera in history_dir/<cam_id>.frames, for re-scoring, 0 turns it off
+			The file is kept when turned off, and is reused if it has the same frame shape when turned on again
+		"""
+		camera = self.cameras[cam_id]
+		if(frames and not os.path.isdir(self.history_dir)):
+			os.makedirs(self.history_dir)
+		camera.history_frames = frames
+		camera.history_path = os.path.join(self.history_dir, cam_id + ".frames") if frames else None
+		if(not frames):
+			camera.history = None
+
+	def set_zones(self, cam_id, zones):
+		""" Sets the zones of a camera (see Camera.set_zones), and marks it for saving """
+		with self.db_lock:
+			self.cameras[cam_id].set_zones(zones)
+			self.dirty_cameras.add(cam_id)
+
 	def subscribe_camera(self, user, cam):
 		""" Subscribes a user to a camera """
-		self.users[user].register_camera(cam)
-		self._save_to_file()
+		with self.db_lock:
+			self.users[user].register_camera(cam)
+			self.dirty_users.add(user)
 		
 	def unsubscribe_camera(self, user, cam):
 		""" Unsubscribes a user from a camera """
-		self.users[user].unregister_camera(cam)
-		self._save_to_file()
+		with self.db_lock:
+			self.users[user].unregister_camera(cam)
+			self.dirty_users.add(user)
 	
+	def nearby_cameras(self, lat=None, lon=None, limit=20, offset=0, exclude=None):
+		""" 
+			Returns a page of (distance, cam_id, camera) tuples, nearest first, skipping exclude
+			Distance is NO_LOCATION (10000 km) for cameras without location, or if lat/lon are not given
+		"""
+		try:
+			nearest = self.geo_index.nearest(float(lat), float(lon), limit, offset, exclude)
+		except (ValueError, TypeError):
+			# No usable location for the user, list the cameras in the order they were added
+			nearest = list()
+			skipped = 0
+			for cam_id in range(self.maxCamId):
+				cam_id = str(cam_id)
+				if(cam_id not in self.cameras or (exclude and cam_id in exclude)):
+					continue
+				if(skipped < offset):
+					skipped += 1
+					continue
+				if(len(nearest) >= limit):
+					break
+				nearest.append((NO_LOCATION, cam_id))
+		return [(distance, cam_id, self.cameras[cam_id]) for (distance, cam_id) in nearest]
+
+	def cameras_within(self, lat, lon, radius, limit=None, offset=0, exclude=None):
+		""" Returns (distance, cam_id, camera) tuples for the cameras within radius kilometers, nearest first """
+		nearby = self.geo_index.within(float(lat), float(lon), radius, limit, offset, exclude)
+		return [(distance, cam_id, self.cameras[cam_id]) for (distance, cam_id) in nearby]
+
+	def subscribers(self, cam_id):
+		""" Returns the names of the users subscribed to a camera, answered by the storage after writing pending changes """
+		self.flush()
+		return self.storage.subscribers(cam_id)
+
+	def cameras_in_box(self, min_lat, max_lat, min_lon, max_lon):
+		""" Returns the ids of the cameras inside a bounding box, answered by the storage after writing pending changes """
+		self.flush()
+		return self.storage.cameras_in_box(float(min_lat), float(max_lat), float(min_lon), float(max_lon))
+
 	def _load_from_file(self):
 		""" Load users and cameras from disk """
-		key = self.camera_db.firstkey()
-		while key != None:
+		for (key, record) in self.storage.load_cameras():
 			if(int(key) >= self.maxCamId):
 				self.maxCamId = int(key) + 1
-			self.cameras[key] = Camera(dbm_input=json.loads(self.camera_db[key]))
-			key = self.camera_db.nextkey(key)
+			self._attach(key, Camera(dbm_input=record))
 			
-		key = self.user_db.firstkey()
-		while key != None:
+		for (key, subscriptions) in self.storage.load_users():
 			self.users[key] = User(key)
-			self.users[key].add_cameras(json.loads(self.user_db[key]))
-			key = self.user_db.nextkey(key)
+			self.users[key].add_cameras(subscriptions)
 
-	def _save_to_file(self):
-		""" Save users and cameras to disk """
-		for (key,value) in self.cameras.items():
-			self.camera_db[key] = value.get_dbm()
-			
-		for (key, value) in self.users.items():
-			self.user_db[key] = json.dumps(value.get_cameras())
-			
-	def update_cameras(self, user_id):
+	def start_scheduler(self, workers=4, warmup=16):
 		""" 
-			Updates all the cameras a user is subscribed to, not currently used,
-			but is needed when there are more cameras.
-			Only updates cameras that have not been updated in camera.interval seconds
+			Starts refreshing cameras in the background, instead of on the request thread
+			Cameras not fetched yet are first fetched by up to warmup threads, so startup does not wait for them
 		"""
-		for cam_id in self.users[user_id].get_cameras():
-			camera = self.cameras[cam_id]
-			if(time.time() - camera.last_updated > camera.update_interval):
-				camera.update()
-				
-	def update_all_cams(self):
-		""" Updates all cameras that have not been updated in camera.interval seconds """
-		cur_time = time.time()
-		for (cam_id, cam) in self.cameras.items():
-			if(cur_time - cam.last_updated > cam.update_interval):
-				cam.update()
+		if(self.scheduler == None):
+			self.scheduler = Scheduler(self, workers)
+			self.scheduler.start(warmup)
+		return self.scheduler
+
+	def stop_scheduler(self):
+		""" Stops the background refresh, if it is running """
+		if(self.scheduler):
+			self.scheduler.stop()
+			self.scheduler = None
+
+	def next_update(self, cam_id):
+		""" Returns the time at which a camera is next due for a refresh, using its current (possibly adapted) interval and its health """
+		camera = self.cameras[cam_id]
+		# A failing camera is not retried before its backoff has passed
+		return max(camera.last_updated + camera.current_interval, camera.health.next_attempt())
+
+	def refresh_camera(self, cam_id):
+		""" Refreshes a single camera and records its activity, called by the scheduler workers """
+		camera = self.cameras[cam_id]
+		changed = camera.update()
+		if(changed):
+			snapshot = camera.snapshot
+			self.activity_store.record(cam_id, snapshot.frame_time, int(snapshot.activity))
+			with self.subscriptions_lock:
+				subscriptions = list(self.subscriptions.get(cam_id, ()))
+			for subscription in subscriptions:
+				subscription.notify()
+		if(self.adaptive):
+			camera.current_interval = self.adaptive.next_interval(camera, changed, camera.last_updated)
+
+	def subscribe_frames(self, cam_ids):
+		""" Returns a FrameSubscription notified of new frames of the given cameras, unsubscribe_frames it when done """
+		subscription = FrameSubscription()
+		with self.subscriptions_lock:
+			for cam_id in set(cam_ids):
+				self.subscriptions.setdefault(cam_id, set()).add(subscription)
+		return subscription
+
+	def unsubscribe_frames(self, subscription):
+		""" Stops notifying a subscription """
+		with self.subscriptions_lock:
+			for (cam_id, subscriptions) in list(self.subscriptions.items()):
+				subscriptions.discard(subscription)
+				if(not subscriptions):
+					del self.subscriptions[cam_id]
 
 if __name__ == "__main__":
 	man = Manager()
@@ -247,9 +767,10 @@ if __name__ == "__main__":
 	
 	
 
-	man.update_cameras("Edvard")
 	for cam in man.users["Edvard"].cameras:
-		man.cameras[cam].update()
+		# Refreshed the same way as by the scheduler
+		man.refresh_camera(cam)
 		cv2.namedWindow(man.cameras[cam].url, cv2.CV_WINDOW_AUTOSIZE)
-		#cv2.imshow(man.cameras[cam].url, man.cameras[cam].output_image)
+		#cv2.imshow(man.cameras[cam].url, man.cameras[cam].snapshot.image.array)
 	cv2.waitKey()
+	man.close()
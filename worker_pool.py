@@ -0,0 +1,146 @@
+import multiprocessing
+import threading
+import zlib
+import numpy as np
+from algorithm_factory import Factory as algFac
+
+# Large enough for a full HD colour frame
+DEFAULT_FRAME_BYTES = 1920 * 1080 * 3
+# Processed images may be colour images of grayscale frames, so results can be this many times the frame size
+OUTPUT_CHANNELS = 3
+
+class SharedFrame:
+	""" A buffer in shared memory holding one uint8 frame, created before the worker is forked """
+	def __init__(self, size):
+		self.size = size
+		self.raw = multiprocessing.RawArray('B', size)
+		self.array = None
+
+	def write(self, image):
+		""" Copies an image into the buffer """
+		self._view(image.size)[:] = image.ravel()
+
+	def read(self, shape):
+		""" Returns a copy of the frame of the given shape, so the buffer can be reused """
+		return self._view(int(np.prod(shape))).reshape(shape).copy()
+
+	def _view(self, count):
+		""" A NumPy view of the first count bytes of the buffer """
+		if(self.array is None):
+			# Created lazily, so the view is made in the process using it
+			self.array = np.frombuffer(self.raw, dtype=np.uint8)
+		return self.array[:count]
+
+def _worker_main(connection, frame_in, frame_out):
+	"""
+		Worker process, runs algorithms on frames from frame_in and writes the result to frame_out
+		Algorithm instances and previous frames are kept per camera, so stateful algorithms work
+	"""
+	cameras = dict()
+	while True:
+		task = connection.recv()
+		if(task == None):
+			return
+		(cam_id, alg_id, sensitivity, shape, has_prev, reset) = task
+		try:
+			state = cameras.get(cam_id)
+			if(reset or state == None or state["alg_id"] != (alg_id, sensitivity)):
+				state = {"alg_id": (alg_id, sensitivity), "alg": algFac.get_alg(alg_id, sensitivity), "prev": False}
+				cameras[cam_id] = state
+			frame = frame_in.read(shape)
+			prev = state["prev"]
+			if(not has_prev or not isinstance(prev, np.ndarray) or prev.shape != frame.shape):
+				prev = False
+			processed = state["alg"].process(frame, prev).astype(np.uint8, copy=False)
+			state["prev"] = frame
+			if(processed.nbytes > frame_out.size):
+				raise ValueError("Processed image does not fit in the shared buffer")
+			frame_out.write(processed)
+			connection.send((True, processed.shape, state["alg"].get_activity(), state["alg"].get_points()))
+		except Exception as e:
+			connection.send((False, str(e), 0, None))
+
+class Worker:
+	""" Parent side of a worker process, one frame is processed at a time """
+	def __init__(self, frame_bytes):
+		self.frame_in = SharedFrame(frame_bytes)
+		# Algorithms may draw in colour on a grayscale frame
+		self.frame_out = SharedFrame(frame_bytes * OUTPUT_CHANNELS)
+		(self.connection, child_connection) = multiprocessing.Pipe()
+		self.process = multiprocessing.Process(target=_worker_main, args=(child_connection, self.frame_in, self.frame_out))
+		self.process.daemon = True
+		self.process.start()
+		self.lock = threading.Lock()
+
+	def run(self, cam_id, alg, image, has_prev, reset=False):
+		""" 
+			Runs the camera's algorithm on image in the worker, returns (processed image, activity, activity points)
+			If reset is set, the worker starts the camera over with a new instance of the algorithm
+		"""
+		with self.lock:
+			self.frame_in.write(image)
+			self.connection.send((cam_id, alg.id, alg.sensitivity, image.shape, has_prev, reset))
+			(ok, shape, keypoints, points) = self.connection.recv()
+			if(not ok):
+				raise RuntimeError("Algorithm failed in worker: " + shape)
+			return (self.frame_out.read(shape), keypoints, points)
+
+	def close(self):
+		""" Stops the worker process """
+		with self.lock:
+			self.connection.send(None)
+		self.process.join()
+
+class AlgorithmPool:
+	"""
+		Runs detection algorithms in a pool of worker processes, so they are not limited to the server's core
+		Frames are passed through shared memory buffers, and each camera always goes to the same worker,
+		which keeps the camera's algorithm instance and previous frame.
+		Must be created before any threads are started, as the workers are forked.
+	"""
+	def __init__(self, processes=None, frame_bytes=DEFAULT_FRAME_BYTES):
+		""" processes defaults to the number of cores, frame_bytes is the largest frame that can be sent to a worker """
+		if(not processes):
+			processes = multiprocessing.cpu_count()
+		self.frame_bytes = frame_bytes
+		self.workers = [Worker(frame_bytes) for i in range(processes)]
+		# Whether each camera's last frame was processed in this process rather than its worker
+		self.local = dict()
+
+	def bind(self, cam_id):
+		""" Returns a runner for a camera, to be set as Camera.runner """
+		return BoundRunner(self, cam_id)
+
+	def run(self, cam_id, alg, image, prev_image):
+		""" 
+			Runs alg for a camera on image, returns (processed image, activity, activity points, see Algorithm.get_points)
+			Frames too large for the shared buffers are processed here instead, with alg. When a camera moves between
+			this process and its worker, the algorithm it moves to has the state of older frames, so it starts over
+		"""
+		local = image.nbytes > self.frame_bytes
+		moved = self.local.get(cam_id, local) != local
+		self.local[cam_id] = local
+		if(moved):
+			prev_image = False
+		if(local):
+			if(moved):
+				alg.reset()
+			processed = alg.process(image, prev_image)
+			return (processed, alg.get_activity(), alg.get_points())
+		worker = self.workers[zlib.crc32(cam_id) % len(self.workers)]
+		return worker.run(cam_id, alg, image, isinstance(prev_image, np.ndarray), moved)
+
+	def close(self):
+		""" Stops all the worker processes """
+		for worker in self.workers:
+			worker.close()
+
+class BoundRunner:
+	""" Runs the algorithm of a single camera in its worker process """
+	def __init__(self, pool, cam_id):
+		self.pool = pool
+		self.cam_id = cam_id
+
+	def process(self, alg, image, prev_image):
+		""" Returns (processed image, activity, activity points) """
+		return self.pool.run(self.cam_id, alg, image, prev_image)
@@ -0,0 +1,88 @@
+import json
+import cv2
+import numpy as np
+
+def parse_region(value):
+	"""
+		Parses a region, a rectangle [[x0, x1], [y0, y1]] or x0 x1 y0 y1 (as a subset), or a polygon [[x, y], ...] or x,y x,y x,y ...
+		Returns the polygon as a list of [x, y], a rectangle becomes its four corners, raises ValueError if malformed
+	"""
+	if(isinstance(value, basestring)):
+		if("," in value):
+			value = [point.split(",") for point in value.split()]
+		else:
+			numbers = value.split()
+			if(len(numbers) != 4):
+				raise ValueError("A rectangle is four numbers, x0 x1 y0 y1: " + value)
+			value = [numbers[0:2], numbers[2:4]]
+	try:
+		points = [[int(float(x)), int(float(y))] for (x, y) in value]
+	except (ValueError, TypeError):
+		raise ValueError("Malformed zone: " + json.dumps(value))
+	if(len(points) == 2):
+		((x0, x1), (y0, y1)) = points
+		if(x0 >= x1 or y0 >= y1):
+			raise ValueError("Empty rectangle: " + json.dumps(points))
+		return [[x0, y0], [x1, y0], [x1, y1], [x0, y1]]
+	if(len(points) < 3):
+		raise ValueError("A polygon needs at least three points: " + json.dumps(points))
+	return points
+
+def parse_zones(value):
+	"""
+		Parses the zones of a camera, a dict (or JSON object) of name: region, or text with one "name: region" per line
+		Returns a dict of name: polygon (see parse_region), None if there are no zones
+	"""
+	if(isinstance(value, basestring)):
+		value = value.strip()
+		if(value.startswith("{")):
+			value = json.loads(value)
+		else:
+			lines = [line.split(":", 1) for line in value.splitlines() if line.strip()]
+			if([line for line in lines if len(line) != 2]):
+				raise ValueError("Zones are given as one name: region per line")
+			value = [(name.strip(), region) for (name, region) in lines]
+	if(not value):
+		return None
+	if(isinstance(value, dict)):
+		value = value.items()
+	return dict((name, parse_region(region)) for (name, region) in value)
+
+class ZoneCounter:
+	"""
+		Counts the activity points of a frame inside each zone of a camera
+		The zones are drawn once into a stack of masks over the region of interest, so counting is a single lookup of all points
+	"""
+	def __init__(self, zones):
+		""" zones is a dict of name: polygon, in frame coordinates """
+		self.names = sorted(zones)
+		self.polygons = [np.array(zones[name], dtype=np.int32) for name in self.names]
+		# Masks are made for a region of interest shape and origin, and remade if those change
+		self.key = None
+		self.masks = None
+
+	def count(self, points, shape, origin=(0, 0)):
+		"""
+			Returns a dict of zone name: number of points inside it, points are (x, y) in the region of interest
+			shape is the shape of the region of interest, origin its top left corner in the frame
+		"""
+		masks = self._masks(shape[:2], origin)
+		points = np.asarray(points, dtype=np.float32).reshape(-1, 2).astype(np.int32)
+		(xs, ys) = (points[:, 0], points[:, 1])
+		inside = (xs >= 0) & (xs < shape[1]) & (ys >= 0) & (ys < shape[0])
+		counts = masks[:, ys[inside], xs[inside]].sum(axis=1)
+		return dict((name, int(count)) for (name, count) in zip(self.names, counts))
+
+	def memory_usage(self):
+		""" Bytes of the masks """
+		return self.masks.nbytes if self.masks is not None else 0
+
+	def _masks(self, size, origin):
+		""" The masks for a region of interest, one per zone, made when first needed """
+		key = (size, tuple(origin))
+		if(key != self.key):
+			masks = np.zeros((len(self.polygons),) + size, dtype=np.uint8)
+			for (mask, polygon) in zip(masks, self.polygons):
+				cv2.fillPoly(mask, [polygon - np.array(origin, dtype=np.int32)], 1)
+			(self.masks, self.key) = (masks.astype(bool), key)
+		return self.masks